@@ -9,6 +9,10 @@
 VERSION = '1.00'
 VERS_DATE = '2021-07-22'
 
+# bump this whenever the same capture would render differently;
+# it keeps stale outputs from coming out of the render cache
+RENDER_VERSION = 1
+
 # v1.00 - 2021-07-22 - Print to html files (most text only)
 #
 # v0.06 - 2021-07-21 - More sounds supported Fleshed out more docs
@@ -44,7 +48,48 @@ config = {
     # general configuration stuff
     'audio'         : True,              # should we output audio?
     'printdir'      : 'Printouts/',      # where we store all printouts
+    'tempdir'       : 'Printouts/',      # in-progress printouts (same disk as printdir)
     'reprintdir'    : 'Reprints/',       # Where all reprint content comes from
+    'reprintchunk'  : 64 * 1024,         # bytes fed in at a time when reprinting
+                                         # (1 to go byte by byte, for debugging)
+    'reprintindex'  : '.reprints.json',  # what we know about each reprint (in reprintdir)
+    'reprintpage'   : 20,                # captures shown per page of the list
+
+    # printers hosted by --server mode, as 'NAME=SOURCE'.  SOURCE is a
+    # serial port (/dev/ttyUSB0, or /dev/ttyUSB0@19200), 'pty' for a new
+    # pseudo-terminal, or 'tcp:PORT' (or 'tcp:HOST:PORT').  Each one's
+    # printouts go into printdir/NAME/
+    'printers'      : [],
+    'listenport'    : 9100,              # for --listen with no port given
+    'timedcapture'  : True,              # also save a .iwt capture with timing
+    'compresscaptures' : True,           # gzip captures as they come in (.raw.gz)
+    'capturesync'   : 2.0,               # seconds, at most, before captured
+    'capturesyncbytes' : 64 * 1024,      #   ..or this many bytes get synced to disk
+    'capturelimit'  : 64 * 1024 * 1024,  # start a new capture file at this size (0: never)
+    'ringbuffer'    : 256 * 1024,        # bytes held between the serial port and the parser
+    'spoolworkers'  : 2,                 # threads finishing torn off pages (0: finish them inline)
+
+    # the printer's input buffer, and the handshaking it does as it fills.
+    # When enabled, this replaces 'ringbuffer' above.
+    'flowcontrol'   : {
+        'enabled'   : True,
+        'buffersize': 2 * 1024,         # 2K, or 32K with the memory option card
+        'drainrate' : 0,                # bytes/sec taken out; 0 = as fast as we go
+        'dtr'       : True,             # drop DTR when the buffer is nearly full
+        'dtroff'    : 30,               #   below this many bytes free
+        'dtron'     : 100,              #   and raise it again above this many
+        'xonxoff'   : True,             # send XOFF when the buffer is filling up
+        'xoff'      : 266,              #   below this many bytes free
+        'xon'       : 337,              #   and XON again above this many
+    },
+
+    # rendered outputs, kept by the content of the capture that made them
+    'cache'     : {
+        'enabled'   : True,
+        'dir'       : 'Printouts/.cache/',  # same disk as printdir, for links
+        'link'      : True,                 # hard link outputs out of the cache
+                                            # (False to copy them)
+    },
 
     # HTML output specific stuff
     'html'      : {
@@ -52,7 +97,32 @@ config = {
         'footer'    : 'Templates/PageFooter.shtml',
         'copyfiles'     : [ 
             [ 'Templates/llamawriter.css', 'Printouts/llamawriter.css' ],
-        ]
+        ],
+
+        # output buffering of the page body.  It always gets flushed at
+        # tear-off, and also whenever any of these trip.
+        'buffersize'    : 16 * 1024,        # flush when this many bytes are held
+        'flushinterval' : 2.0,              # flush if it's been this many seconds
+        'flushon'       : [ 'CR', 'FF' ],   # flush on these control codes
+    },
+
+    # graphics (png) output specific stuff
+    'raster'    : {
+        'enabled'   : True,     # render graphics to png (needs numpy)
+        'hdpi'      : 160,      # horizontal resolution; the finest dot density
+        'pagewidth' : 8.0,      # printable width, in inches
+        'bandrows'  : 512,      # rows kept in memory before streaming out
+        'pagebreaks': True,     # split pages at the page length (False for
+                                # continuous paper; banners become one png)
+        'color'     : True,     # color ribbon; 4 bit color png.
+                                # (False for black only, 1 bit png)
+
+        # TTF fonts used to draw text (needs Pillow). See docs/fonts.md
+        'fonts'     : {
+            'draft'         : 'Fonts/ImgWriterDraft.ttf',
+            'correspondence': 'Fonts/ImgWriterCorrespondence.ttf',
+            'nlq'           : 'Fonts/ImgWriterNLQ.ttf',
+        },
     },
 
     # sound/audio specific stuff
@@ -75,6 +145,26 @@ import serial
 import serial.threaded
 import time
 import os
+import re
+import shutil
+import filecmp
+import struct
+import zlib
+import gzip
+import io
+import mmap
+import json
+import hashlib
+import base64
+import copy
+import tempfile
+import contextlib
+import threading
+import concurrent.futures
+import collections
+import itertools
+import asyncio
+import socket
 
 import subprocess
 
@@ -84,6 +174,12 @@ from serial.tools import hexlify_codec
 from os import listdir
 from os.path import isfile, join
 
+# numpy is optional.  Without it, there's no graphics (png) output.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -189,6 +285,14 @@ class LlamaAudio():
 
 
 class LlamaPrintout() :
+
+    # state flags that get a <span class="iw-FLAG"> around them
+    styleSpans = [
+        #'doublewidth', 'halfheight', 
+        'bold', #'italic', 'underline',
+        #'superscript', 'subscript'
+    ]
+
     def __init__( self, globalConfig ):
         self.config = globalConfig
 
@@ -197,8 +301,20 @@ class LlamaPrintout() :
         self.state = None       # current printer state
         self.htmlFile = None    # current html <body> file
 
+        # buffered output for the html file
+        self.outBuffer = bytearray()
+        self.lastFlush = time.monotonic()
+        self.flushSize = self.config[ 'html' ][ 'buffersize' ]
+        self.flushInterval = self.config[ 'html' ][ 'flushinterval' ]
+        self.flushOn = self.config[ 'html' ][ 'flushon' ]
+
         # filename for the current 
-        self.tempFilepath = '{}{}'.format( self.config[ 'printdir' ], '.Current.html' )
+        self.tempFilepath = '{}{}'.format( self.config[ 'tempdir' ], '.Current.html' )
+
+        # page header/footer templates, and extra files already copied out
+        self.LoadTemplates()
+        self.copiedFiles = {}
+        self.bodySize = 0
 
         self.StartNewFile()
 
@@ -208,33 +324,41 @@ class LlamaPrintout() :
 
 
     # --- file utilities
-    def AppendToFile( self, src, dest ):
-        buffer_size=1024*32
+    def LoadFile( self, src ):
+        """ read in the entire file, returns b'' if it can't be read """
+        try:
+            with open( src, 'rb' ) as srcfile:
+                return srcfile.read()
+
+        except Exception as e:
+            print( e )
+            print( "Error loading file {}".format( src ))
+            return b''
 
+    def LoadTemplates( self ):
+        """ load the page header and footer into memory """
+        self.pageHeader = self.LoadFile( self.config[ 'html' ][ 'header' ] )
+        self.pageFooter = self.LoadFile( self.config[ 'html' ][ 'footer' ] )
+
+    def CopyFileIfChanged( self, src, dest ):
+        """ copy src to dest, but only if dest doesn't already have the same content """
         try:
-            srcfile = open( src, 'r' ) 
-            dstfile = open( dest, 'a' )
+            srcStat = os.stat( src )
+            stamp = ( srcStat.st_mtime_ns, srcStat.st_size )
 
-            while True:
-                copy_buffer = srcfile.read(buffer_size)
-                if not copy_buffer:
-                    break
-                dstfile.write(copy_buffer)
+            # we've already put this exact version of it there
+            if self.copiedFiles.get( src ) == stamp and os.path.exists( dest ):
+                return
+
+            if not ( os.path.exists( dest ) and filecmp.cmp( src, dest, shallow=False )):
+                shutil.copyfile( src, dest )
 
-            dstfile.close()
-            srcfile.close()
+            self.copiedFiles[ src ] = stamp
 
         except Exception as e:
             print( e )
-            print( "Error appending file {} to {}".format( src, dest ))
-            pass
-
-    def CopyFile( self, src, dest ):
-        try:
-            os.remove( dest )
-        except:
+            print( "Error copying file {} to {}".format( src, dest ))
             pass
-        self.AppendToFile( src, dest )
 
 
     # --- interaction functionality
@@ -247,38 +371,46 @@ class LlamaPrintout() :
 
         # if nothing is open, there's nothing to do
         if self.htmlFile == None:
-            return; # nothing to do
+            return None; # nothing to do
 
         # save the opened file
-        self.htmlFile.close()
-        self.htmlFile = None
+        self.Flush()
 
         # now check if it's empty
-        if os.stat( self.tempFilepath ).st_size == 0:
+        if self.bodySize == 0:
             # nothing to do
             # don't need to delete it, since the new one will overwrite it.
-            return
+            self.htmlFile.close()
+            self.htmlFile = None
+            return None
 
-        # now build the destination html file
-        destFilepath = '{}{}.html'.format( self.config[ 'printdir' ], copyTo )
+        # the header went in when the file was started, so finishing the
+        # page is just the footer, then move it into place.
+        self.htmlFile.write( self.pageFooter )
+        self.htmlFile.close()
+        self.htmlFile = None
 
-        self.AppendToFile( self.config[ 'html' ][ 'header' ], destFilepath );
-        self.AppendToFile( self.tempFilepath, destFilepath );
-        self.AppendToFile( self.config[ 'html' ][ 'footer' ], destFilepath );
+        destFilepath = '{}{}.html'.format( self.config[ 'printdir' ], copyTo )
+        os.replace( self.tempFilepath, destFilepath )
 
         print( "Your new printout is: ", destFilepath )
-        # and delete the temporary file.
-        os.remove( self.tempFilepath )
 
         # copy over extra files
         for fn in self.config[ 'html' ][ 'copyfiles' ]:
-            self.CopyFile( fn[0], fn[1] )
+            self.CopyFileIfChanged( fn[0], fn[1] )
+
+        return destFilepath
 
 
     def StartNewFile( self, filename = None ):
-        self.CloseFile( filename )
+        """ finish the current file, and start a new one.
+            returns the finished printout's filename, if one was saved """
+        saved = self.CloseFile( filename )
         self.htmlFile = open( self.tempFilepath, "wb" );
+        self.htmlFile.write( self.pageHeader )
+        self.bodySize = 0
         #print( "Opened {} for write".format( self.tempFilepath ) )
+        return saved
 
 
     def TearOff( self, filename=None ):
@@ -286,7 +418,28 @@ class LlamaPrintout() :
         if filename == None:
             filename = 'Saved_{}'.format( time.time() )
 
-        self.StartNewFile( filename )
+        return self.StartNewFile( filename )
+
+    def Spool( self, filename=None ):
+        """ tear off a page, but leave finishing it for later.  The page is
+            moved aside and a new one started right away; returns a
+            function that finishes the old one (and returns its filename) """
+        if filename == None:
+            filename = 'Saved_{}'.format( time.time() )
+
+        if self.htmlFile == None or ( self.bodySize == 0 and len( self.outBuffer ) == 0 ):
+            saved = self.StartNewFile( filename )
+            return lambda: saved
+
+        # the old page keeps its open file, under another name
+        page = copy.copy( self )
+        page.tempFilepath = '{}.Spool-{}.html'.format( self.config[ 'tempdir' ], LlamaSpooler.Ticket() )
+        os.rename( self.tempFilepath, page.tempFilepath )
+
+        self.htmlFile = None
+        self.outBuffer = bytearray()
+        self.StartNewFile()
+        return lambda: page.CloseFile( filename )
 
 
     def CopyState( self, newState ):
@@ -300,13 +453,7 @@ class LlamaPrintout() :
         #    self.state = newState
         #    return
 
-        stlist = [
-            #'doublewidth', 'halfheight', 
-            'bold', #'italic', 'underline',
-            #'superscript', 'subscript'
-        ]
-
-        for k in stlist:
+        for k in self.styleSpans:
             if not self.state[ k ] == newState[ k ]:
                 if newState[ k ] == False:
                     self.Write( '</span>' )
@@ -316,6 +463,17 @@ class LlamaPrintout() :
         self.CopyState( newState )
 
 
+    def Snapshot( self ):
+        """ the style spans that are open """
+        return { 'spans' : [ k for k in self.styleSpans if self.state[ k ] ] }
+
+    def Restore( self, snapshot, newState ):
+        """ carry on with newState, with the snapshot's spans open again """
+        self.CopyState( newState )
+        for k in snapshot[ 'spans' ]:
+            self.Write( '<span class="iw-{}">'.format( k ))
+
+
     def Control( self, ctrl ):
         if ctrl == 'CR':
             self.Write( "<br/>\n" );
@@ -330,6 +488,9 @@ class LlamaPrintout() :
         else:
             print( '<LLP CTRL {}>'.format( ctrl ))
 
+        if ctrl in self.flushOn:
+            self.Flush()
+
 
 
     def Write( self, ch ):
@@ -339,13 +500,1092 @@ class LlamaPrintout() :
             return
 
         if type(ch) == str:
-            self.htmlFile.write( ch.encode() )
+            self.outBuffer += ch.encode()
+        else:
+            self.outBuffer += ch
+
+        if len( self.outBuffer ) >= self.flushSize:
+            self.Flush()
+
         else:
-            self.htmlFile.write( ch )
+            self.FlushIfDue()
+
+
+    def FlushIfDue( self ):
+        """ flush, if it's been flushinterval since the last time.  Also
+            called while the input is idle, so a half-sent line shows up """
+        if time.monotonic() - self.lastFlush >= self.flushInterval:
+            self.Flush()
+
+
+    def Flush( self ):
+        """ push everything buffered out to the html file """
+        self.lastFlush = time.monotonic()
+
+        if self.htmlFile == None or len( self.outBuffer ) == 0:
+            return
 
+        self.htmlFile.write( self.outBuffer )
         self.htmlFile.flush()
+        self.bodySize += len( self.outBuffer )
+        self.outBuffer = bytearray()
+
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class LlamaPNGStream():
+    """ Write a png a few rows at a time, so that the whole image never
+        has to be in memory.  The height isn't known until it's closed,
+        so it gets patched into the header then.
+
+        Without a palette, it's 1 bit grayscale, and rows are bool (ink).
+        With a palette (list of up to 16 ( r, g, b )), it's 4 bit indexed
+        color, and rows are uint8 palette indexes, 0 being the paper.
+    """
+
+    def __init__( self, filename, width, palette = None ):
+        self.width = width
+        self.height = 0
+        self.palette = palette
+        self.compressor = zlib.compressobj()
+        self.pending = []           # compressed data not yet in an IDAT
+        self.pendingSize = 0
+
+        # a blank (paper) row, including the leading filter type 0 byte
+        if palette == None:
+            self.blankRow = b'\x00' + b'\xff' * (( width + 7 ) // 8 )
+        else:
+            self.blankRow = b'\x00' + b'\x00' * (( width + 1 ) // 2 )
+
+        self.pngFile = open( filename, 'wb' )
+        self.pngFile.write( b'\x89PNG\r\n\x1a\n' )
+        self.WriteChunk( b'IHDR', self.Header() )
+        if not palette == None:
+            self.WriteChunk( b'PLTE', b''.join( bytes( rgb ) for rgb in palette ))
+
+    def __call__( self ):
+        return self
+
+    def Header( self ):
+        if self.palette == None:
+            # 1 bit, grayscale
+            return struct.pack( '>IIBBBBB', self.width, self.height, 1, 0, 0, 0, 0 )
+        # 4 bit, indexed color
+        return struct.pack( '>IIBBBBB', self.width, self.height, 4, 3, 0, 0, 0 )
+
+    def WriteChunk( self, kind, data ):
+        self.pngFile.write( struct.pack( '>I', len( data )) + kind + data
+            + struct.pack( '>I', zlib.crc32( kind + data )))
+
+    def Compressed( self, data, flush = False ):
+        """ collect compressed data, writing out IDATs as it piles up """
+        if len( data ):
+            self.pending.append( data )
+            self.pendingSize += len( data )
+
+        if self.pendingSize >= 64 * 1024 or ( flush and self.pendingSize ):
+            self.WriteChunk( b'IDAT', b''.join( self.pending ))
+            self.pending = []
+            self.pendingSize = 0
+
+    def WriteRows( self, rows ):
+        """ rows is a ( n, width ) array of ink (or palette indexes) """
+        if self.palette == None:
+            # 1 is white
+            packed = numpy.packbits( ~rows, axis=1 )
+        else:
+            # two pixels per byte, high nybble first
+            if self.width % 2:
+                rows = numpy.pad( rows, ( ( 0, 0 ), ( 0, 1 )))
+            packed = ( rows[ :, 0::2 ] << 4 ) | rows[ :, 1::2 ]
+
+        # each scanline starts with filter type 0
+        raw = numpy.zeros( ( packed.shape[0], packed.shape[1] + 1 ), dtype=numpy.uint8 )
+        raw[ :, 1: ] = packed
+
+        self.Compressed( self.compressor.compress( raw.tobytes() ))
+        self.height += rows.shape[0]
+
+    def WriteBlankRows( self, count ):
+        while count > 0:
+            n = min( count, 1024 )
+            self.Compressed( self.compressor.compress( self.blankRow * n ))
+            self.height += n
+            count -= n
+
+    def Close( self ):
+        self.Compressed( self.compressor.flush(), True )
+        self.WriteChunk( b'IEND', b'' )
+
+        # now that we know how tall it is, fix up the header
+        self.pngFile.seek( 8 )
+        self.WriteChunk( b'IHDR', self.Header() )
+        self.pngFile.close()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class LlamaGlyphs():
+    """ Character bitmaps for drawing text on the raster output.
+
+        Glyphs are rendered from the fonts in config[ 'raster' ][ 'fonts' ]
+        (TTF files, see docs/fonts.md; needs Pillow) onto the print head's
+        dot grid: 9 dots tall, 8 dots wide for the fixed pitches, 16 for
+        the proportional ones.  The plain dot glyph is made once per
+        character, the styled version (bold, double width, ...) once per
+        style, and the version stretched out to the page's pixel grid once
+        per pitch.  Text then is just dictionary lookups.
+    """
+
+    # national character sets; code -> character, on top of ASCII
+    languages = {
+        'British'   : { 0x23: '£' },
+        'German'    : { 0x40: '§', 0x5b: 'Ä', 0x5c: 'Ö', 0x5d: 'Ü',
+                        0x7b: 'ä', 0x7c: 'ö', 0x7d: 'ü', 0x7e: 'ß' },
+        'French'    : { 0x23: '£', 0x40: 'à', 0x5b: '°', 0x5c: 'ç', 0x5d: '§',
+                        0x7b: 'é', 0x7c: 'ù', 0x7d: 'è', 0x7e: '¨' },
+        'Italian'   : { 0x23: '£', 0x40: '§', 0x5b: '°', 0x5c: 'ç', 0x5d: 'é',
+                        0x60: 'ù', 0x7b: 'à', 0x7c: 'ò', 0x7d: 'è', 0x7e: 'ì' },
+        'Swedish'   : { 0x40: 'É', 0x5b: 'Ä', 0x5c: 'Ö', 0x5d: 'Å', 0x5e: 'Ü',
+                        0x60: 'é', 0x7b: 'ä', 0x7c: 'ö', 0x7d: 'å', 0x7e: 'ü' },
+        'Danish'    : { 0x5b: 'Æ', 0x5c: 'Ø', 0x5d: 'Å', 0x7b: 'æ', 0x7c: 'ø',
+                        0x7d: 'å' },
+        'Spanish'   : { 0x23: '£', 0x40: '§', 0x5b: '¡', 0x5c: 'Ñ', 0x5d: '¿',
+                        0x7b: '°', 0x7c: 'ñ', 0x7d: 'ç' },
+    }
+
+    # MouseText replaces 0x40..0x5f; these are where the Apple II fonts
+    # (docs/fonts.md) keep those glyphs.
+    mouseTextBase = 0xe080
+
+    # a missing font is only complained about once
+    fontWarned = False
+
+    def __init__( self, globalConfig, hdpi, vdpi ):
+        self.config = globalConfig
+        self.hdpi = hdpi
+        self.vdpi = vdpi
+
+        self.fonts = {}         # font name -> ImageFont, or None if unavailable
+        self.dotGlyphs = {}     # ( font, charset, language, cols, ch ) -> plain dots
+        self.styles = {}        # style key -> { ch -> pixel bitmap }
+
+        try:
+            from PIL import Image, ImageDraw, ImageFont
+            self.Image = Image
+            self.ImageDraw = ImageDraw
+            self.ImageFont = ImageFont
+            self.enabled = True
+        except ImportError:
+            self.enabled = False
+
+    def __call__( self ):
+        return self
+
+
+    def Font( self, name ):
+        """ load (once) the font for this name.  Relative paths are from
+            this script's directory.  If the font can't be loaded, Pillow's
+            own font stands in for it. """
+        if name in self.fonts:
+            return self.fonts[ name ]
+
+        # size it so that capitals come out about 7 dots tall
+        size = 10 * 16
+        self.fonts[ name ] = None
+        path = self.config[ 'raster' ][ 'fonts' ].get( name )
+        if path:
+            path = self.FontPath( path )
+            try:
+                self.fonts[ name ] = self.ImageFont.truetype( path, size )
+            except OSError as e:
+                if not LlamaGlyphs.fontWarned:
+                    print( "--- {}: Unable to load font {}: {}".format( name, path, e ))
+                    print( "--- Using the default font instead.  See docs/fonts.md" )
+                    LlamaGlyphs.fontWarned = True
+                self.fonts[ name ] = self.DefaultFont( size )
+
+        return self.fonts[ name ]
+
+    @staticmethod
+    def FontPath( path ):
+        """ where a configured font is; relative to this script """
+        return os.path.join( os.path.dirname( os.path.abspath( __file__ )), path )
+
+    def DefaultFont( self, size ):
+        """ Pillow's built in font, scalable if this Pillow has it """
+        try:
+            font = self.ImageFont.load_default( size )
+        except TypeError:
+            font = self.ImageFont.load_default()
+
+        # the old bitmap one can't be drawn at a baseline
+        if isinstance( font, self.ImageFont.FreeTypeFont ):
+            return font
+        return None
+
+    def CharFor( self, ch, charset, language ):
+        """ the character that gets printed for the byte """
+        if charset == 'MouseText' and 0x40 <= ch <= 0x5f:
+            return chr( self.mouseTextBase + ch - 0x40 )
+        return self.languages.get( language, {} ).get( ch, chr( ch ))
+
+    def DotGlyph( self, font, charset, language, cols, ch ):
+        """ the plain ( 9, cols ) dot bitmap for the character, or None """
+        key = ( font, charset, language, cols, ch )
+        if key in self.dotGlyphs:
+            return self.dotGlyphs[ key ]
+
+        dots = None
+        ttf = self.Font( font )
+        if ttf is not None:
+            # render big, then each dot is on if enough of its block is inked.
+            # Baseline is under the 7th dot; the last two are descenders.
+            bw = 16 * 8 // cols
+            img = self.Image.new( 'L', ( cols * bw, 9 * 16 ))
+            self.ImageDraw.Draw( img ).text( ( 0, 7 * 16 ),
+                self.CharFor( ch, charset, language ), font=ttf, fill=255, anchor='ls' )
+            pixels = numpy.asarray( img, dtype=numpy.uint16 )
+            dots = pixels.reshape( 9, 16, cols, bw ).mean( axis=( 1, 3 )) > 80
+
+        self.dotGlyphs[ key ] = dots
+        return dots
+
+    def StyleKey( self, state ):
+        return ( state[ 'font' ], state[ 'pitch' ], state[ 'bold' ], state[ 'underline' ],
+            state[ 'doublewidth' ], state[ 'halfheight' ], state[ 'superscript' ],
+            state[ 'subscript' ], state[ 'charset' ], state[ 'language' ],
+            state[ 'dotspacing' ] )
+
+    def Glyphs( self, state ):
+        """ the character -> pixel bitmap cache for this style """
+        key = self.StyleKey( state )
+        cache = self.styles.get( key )
+        if cache is None:
+            cache = {}
+            self.styles[ key ] = cache
+        return key, cache
+
+    def Glyph( self, key, cache, ch, dpi ):
+        """ pixel bitmap for the character in this style, or None """
+        bitmap = cache.get( ch )
+        if bitmap is not None or ch in cache:
+            return bitmap
+
+        ( font, pitch, bold, underline, doublewidth, halfheight,
+            superscript, subscript, charset, language, dotspacing ) = key
+        proportional = dpi in ( 144, 160 )
+        cols = 16 if proportional else 8
+
+        dots = self.DotGlyph( font, charset, language, cols, ch )
+        if dots is None:
+            cache[ ch ] = None
+            return None
+
+        if proportional:
+            # trim to the inked columns, plus a space and the dot spacing
+            inked = numpy.flatnonzero( dots.any( axis=0 ))
+            if len( inked ):
+                dots = dots[ :, inked[0]:inked[-1]+1 ]
+            else:
+                dots = dots[ :, :8 ]
+            dots = numpy.pad( dots, ( ( 0, 0 ), ( 0, 1 + dotspacing )))
+
+        if halfheight or superscript or subscript:
+            # squash the top 8 rows into 4, up top or down low
+            half = dots[ :8 ].reshape( 4, 2, -1 ).any( axis=1 )
+            dots = numpy.zeros_like( dots )
+            if subscript:
+                dots[ 4:8 ] = half
+            else:
+                dots[ 0:4 ] = half
+
+        if bold:
+            # printed twice, the second time one dot over
+            dots = dots.copy()
+            dots[ :, 1: ] |= dots[ :, :-1 ]
+
+        if underline:
+            dots = dots.copy()
+            dots[ 8 ] = True
+
+        if doublewidth:
+            dots = numpy.repeat( dots, 2, axis=1 )
+
+        # out to the pixel grid, same as graphics
+        nPixels = ( dots.shape[1] * self.hdpi ) // dpi
+        src = ( numpy.arange( nPixels ) * dpi ) // self.hdpi
+        bitmap = numpy.repeat( dots[ :, src ], self.vdpi // 72, axis=0 )
+
+        cache[ ch ] = bitmap
+        return bitmap
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class LlamaRaster():
+    """ Graphics output.  Dot columns get put onto a band of the page
+        bitmap.  As the paper feeds past the band, the finished rows are
+        streamed out to a png, so memory use stays the same no matter how
+        long the printout (banners!) is.
+
+        The bitmap is config[ 'raster' ][ 'hdpi' ] across, so that all of
+        the horizontal dot densities fit on the same grid, and 144 dpi
+        down, the smallest line feed step.  Each graphics byte is a column
+        of 8 dots, LSB at the top, 1/72" apart.
+
+        For the color ribbon, each pixel of the band holds a bit for each
+        of the Y, M, C and K planes, which get OR'd in by however many
+        passes the software makes.  The bits are the png palette index, so
+        the palette does the compositing, one lookup per pixel.
+    """
+
+    # ribbon plane bits for each color
+    colorPlanes = {
+        'y' : 0x01,
+        'm' : 0x02,
+        'c' : 0x04,
+        'k' : 0x08,
+        'o' : 0x01 | 0x02,  # orange (YM)
+        'g' : 0x01 | 0x04,  # green (YC)
+        'p' : 0x02 | 0x04,  # purple (MC)
+    }
+
+    # horizontal dots per inch for each character pitch
+    pitchDpi = {
+        9       : 72,       # extended
+        10      : 80,       # pica
+        12      : 96,       # elite
+        13.4    : 107,      # semicondensed
+        15      : 120,      # condensed
+        17      : 136,      # ultracondensed
+        144     : 144,      # pica proportional
+        160     : 160,      # elite proportional
+    }
+
+    def __init__( self, globalConfig ):
+        self.config = globalConfig
+
+        self.enabled = self.config[ 'raster' ][ 'enabled' ] and not numpy == None
+        self.hdpi = self.config[ 'raster' ][ 'hdpi' ]
+        self.vdpi = 144
+        self.width = int( self.config[ 'raster' ][ 'pagewidth' ] * self.hdpi )
+        self.bandRows = self.config[ 'raster' ][ 'bandrows' ]
+        self.glyphs = LlamaGlyphs( globalConfig, self.hdpi, self.vdpi )
+        self.pageBreaks = self.config[ 'raster' ][ 'pagebreaks' ]
+        self.color = self.config[ 'raster' ][ 'color' ]
+
+        # palette index (plane bits) to ( r, g, b ).  Each ink takes away
+        # its complement from white paper; black takes it all.
+        self.palette = None
+        if self.color:
+            self.palette = []
+            for planes in range( 16 ):
+                if planes & 0x08:
+                    self.palette.append( ( 0, 0, 0 ))
+                else:
+                    self.palette.append( (
+                        0 if planes & 0x04 else 255,
+                        0 if planes & 0x02 else 255,
+                        0 if planes & 0x01 else 255 ))
+
+        self.state = None       # current printer state
+
+        self.band = None        # bitmap of the rows near the print head
+        self.bandTop = 0        # page row of the top of the band
+        self.lastInk = -1       # lowest row with ink on it, on this page
+        self.png = None         # current page output, once inked
+        self.pages = []         # finished pages (temp filenames)
+        self.x = 0              # print head position, in pixels
+        self.y = 0              # paper position on the page, in 1/144"
+        self.sheet = 0          # top-of-forms passed since power on
+
+        # filename for the current pages
+        self.tempFilepath = '{}{}'.format( self.config[ 'tempdir' ], '.Current-{:03}.png' )
+
+    def __call__( self ):
+        return self
+
+
+    def UpdateState( self, newState ):
+        self.state = newState
+
+    def Dpi( self ):
+        """ horizontal dot density for the current pitch """
+        return self.pitchDpi.get( self.state[ 'pitch' ], 96 )
+
+    def PageRows( self ):
+        return self.state[ 'pagelength' ]
+
+
+    # --- head and paper motion
+
+    def Control( self, ctrl ):
+        if ctrl == 'CR':
+            self.x = 0
+
+        elif ctrl == 'LF':
+            if self.state[ 'insCRbeforeLF' ]:
+                self.x = 0
+            if self.state[ 'linefeeding' ] == 'reverse':
+                self.y = max( 0, self.y - self.state[ 'linespacing' ] )
+            else:
+                self.y += self.state[ 'linespacing' ]
+                if self.pageBreaks and self.y >= self.PageRows():
+                    self.EndPage()
+                    self.y -= self.PageRows()
+                    self.sheet += 1
+
+        elif ctrl == 'FF':
+            self.x = 0
+            self.EndPage()
+            self.y = 0
+            self.sheet += 1
+
+    def Snapshot( self ):
+        """ head and paper position """
+        return { 'x' : self.x, 'y' : self.y, 'sheet' : self.sheet }
+
+    def Restore( self, snapshot ):
+        self.x = snapshot[ 'x' ]
+        self.y = snapshot[ 'y' ]
+        self.sheet = snapshot[ 'sheet' ]
+
+    def PlaceHead( self, dotCols ):
+        """ ESC F: move the head dotCols from the left margin """
+        self.x = ( dotCols * self.hdpi ) // self.Dpi()
+
+    def Text( self, text ):
+        """ draw a run of text (bytes) at the head, and move past it """
+        dpi = self.Dpi()
+
+        bitmaps = None
+        if self.enabled and self.glyphs.enabled:
+            key, cache = self.glyphs.Glyphs( self.state )
+            bitmaps = [ self.glyphs.Glyph( key, cache, ch, dpi ) for ch in text ]
+            if any( bitmap is None for bitmap in bitmaps ):
+                bitmaps = None
+
+        if bitmaps == None:
+            # no font for it; just move the head along
+            if dpi in ( 144, 160 ):
+                # proportional; average character, plus dot spacing
+                cellDots = 10 + self.state[ 'dotspacing' ]
+            else:
+                cellDots = 8
+            if self.state[ 'doublewidth' ]:
+                cellDots *= 2
+            self.x += ( len( text ) * cellDots * self.hdpi ) // dpi
+            return
+
+        x0 = self.x
+        run = numpy.hstack( bitmaps )
+        self.x += run.shape[1]
+
+        # clip to the paper
+        nPixels = min( run.shape[1], self.width - x0 )
+        if nPixels > 0 and run[ :, :nPixels ].any():
+            self.Ink( self.y, x0, run[ :, :nPixels ] )
+
+
+    # --- ink
+
+    def Graphics( self, data ):
+        """ put a line of dot columns down at the head position """
+        if not self.enabled or len( data ) == 0:
+            return
+
+        dpi = self.Dpi()
+        x0 = self.x
+        nPixels = ( len( data ) * self.hdpi ) // dpi
+        self.x += nPixels
+
+        # clip to the paper
+        nPixels = min( nPixels, self.width - x0 )
+        if nPixels <= 0:
+            return
+
+        # (8, n) array of dots, row 0 is the top (LSB)
+        cols = numpy.frombuffer( data, dtype=numpy.uint8 )
+        dots = numpy.unpackbits( cols[ numpy.newaxis, : ], axis=0, bitorder='little' )
+
+        # stretch the columns out to our horizontal grid, and each dot
+        # out to its 1/72" of height.
+        src = ( numpy.arange( nPixels ) * dpi ) // self.hdpi
+        band = numpy.repeat( dots[ :, src ], self.vdpi // 72, axis=0 )
+
+        self.Ink( self.y, x0, band.astype( bool ))
+
+    def Ink( self, y, x, rows ):
+        """ OR the bitmap rows into the page at ( x, y ), in the current color """
+        nRows = rows.shape[0]
+        if self.pageBreaks:
+            nRows = min( nRows, self.PageRows() - y )
+
+        # rows that have already been streamed out can't be changed
+        # (only happens with reverse line feeds)
+        skip = max( 0, self.bandTop - y )
+        if nRows <= skip:
+            return
+
+        if self.png is None:
+            # first ink on this page.
+            self.png = LlamaPNGStream( self.tempFilepath.format( len( self.pages )),
+                self.width, self.palette )
+            self.band = numpy.zeros( ( self.bandRows, self.width ), dtype=numpy.uint8 )
+
+        # make room for it
+        if y + nRows > self.bandTop + self.bandRows:
+            self.StreamTo( y + nRows - self.bandRows )
+
+        planes = 0x08
+        if self.color:
+            planes = self.colorPlanes.get( self.state[ 'color' ], 0x08 )
+
+        top = y + skip - self.bandTop
+        self.band[ top:top + nRows - skip, x:x + rows.shape[1] ] |= (
+            rows[ skip:nRows ].astype( numpy.uint8 ) * planes )
+        self.lastInk = max( self.lastInk, y + nRows - 1 )
+
+    def StreamTo( self, newTop ):
+        """ all rows above newTop are done; write them out, and move the band down """
+        n = newTop - self.bandTop
+        if n <= 0:
+            return
+
+        rows = self.band[ :min( n, self.bandRows ) ]
+        if self.color:
+            self.png.WriteRows( rows )
+        else:
+            self.png.WriteRows( rows != 0 )
+
+        if n >= self.bandRows:
+            self.png.WriteBlankRows( n - self.bandRows )
+            self.band[:] = 0
+        else:
+            self.band[ :-n ] = self.band[ n: ]
+            self.band[ -n: ] = 0
+
+        self.bandTop = newTop
+
+
+    # --- pages
+
+    def EndPage( self ):
+        """ done with this page. if anything was printed, finish its png. """
+        if not self.png is None:
+            # a whole sheet, or just down to the last ink on continuous paper
+            if self.pageBreaks:
+                self.StreamTo( self.PageRows() )
+            else:
+                self.StreamTo( self.lastInk + 1 )
+            self.png.Close()
+            self.pages.append( self.tempFilepath.format( len( self.pages )))
+
+        self.png = None
+        self.band = None
+        self.bandTop = 0
+        self.lastInk = -1
+
+    def TearOff( self, filename=None ):
+        """ finish the page, and move all of the png pages into place.
+            returns their filenames """
+        if filename == None or filename == '':
+            filename = 'Printout_{}'.format( time.time() )
+
+        self.EndPage()
+        self.y = 0
+        self.x = 0
+
+        saved = []
+        for idx, tempFile in enumerate( self.pages ):
+            if len( self.pages ) == 1:
+                destFilepath = '{}{}.png'.format( self.config[ 'printdir' ], filename )
+            else:
+                destFilepath = '{}{}-{:03}.png'.format( self.config[ 'printdir' ], filename, idx+1 )
+
+            os.replace( tempFile, destFilepath )
+            print( "Your new graphics page is: ", destFilepath )
+            saved.append( destFilepath )
+
+        self.pages = []
+        return saved
+
+    def Spool( self, filename=None ):
+        """ like TearOff, but the last of the png streaming and the moving
+            into place is left for the function returned """
+        if filename == None or filename == '':
+            filename = 'Printout_{}'.format( time.time() )
+
+        if self.png is None and len( self.pages ) == 0:
+            saved = self.TearOff( filename )
+            return lambda: saved
+
+        # the old pages (and the open one) go aside, and we start afresh
+        sheets = copy.copy( self )
+        sheets.state = dict( self.state )
+        sheets.tempFilepath = '{}.Spool-{}-{{:03}}.png'.format( self.config[ 'tempdir' ], LlamaSpooler.Ticket() )
+        count = len( self.pages ) + ( 0 if self.png is None else 1 )
+        for idx in range( count ):
+            os.rename( self.tempFilepath.format( idx ), sheets.tempFilepath.format( idx ))
+        sheets.pages = [ sheets.tempFilepath.format( idx ) for idx in range( len( self.pages )) ]
+
+        self.png = None
+        self.band = None
+        self.bandTop = 0
+        self.lastInk = -1
+        self.pages = []
+        self.y = 0
+        self.x = 0
+        return lambda: sheets.TearOff( filename )
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class IWDecoder():
+    """ Incremental ImageWriter protocol decoder.
+
+        Feed it any chunk of bytes, split anywhere, and it turns them into
+        a stream of events.  It keeps only the parse state it needs to
+        resume on the next chunk; no printer state, no output.
+
+            ( 'text', b'...' )              run of plain content
+            ( 'ctrl', ch )                  control character
+            ( 'esc', seq, args )            complete escape sequence.  seq is
+                                            the bytes after ESC, args is a
+                                            tuple of the parsed parameters
+            ( 'badesc', ch )                unknown escape opcode
+            ( 'gfx', opcode, data )         graphics dot column data that
+                                            follows an ESC G, S or g.  data is
+                                            a memoryview, usually a slice of
+                                            the chunk itself, so copy it if
+                                            it needs to be kept around.
+
+        Use it as a generator (always run it to the end for each chunk):
+            for ev in decoder.Decode( chunk ): ...
+
+        or push the events to a callback:
+            decoder = IWDecoder( sink=fn )
+            decoder.Feed( chunk )
+
+        decoder.position is the offset in the stream just past the event
+        that was last yielded.
+    """
+
+    # bytes that are control characters.  Everything else that isn't
+    # ESC (0x1b) is plain content.
+    controlBytes = b'\x04\x08\x09\x0a\x0c\x0d\x0e\x0f\x11\x13\x18\x8a\x8d'
+
+    # a run of plain content bytes, up to the next control or ESC byte
+    textRun = re.compile( b'[^' + re.escape( controlBytes + b'\x1b' ) + b']+' )
+
+    # how many of the parameter bytes are ASCII digits making up a number.
+    # Any bytes after those are passed through as-is.
+    escNumeric = {
+        0x54: 2,    # T NN      distance between lines
+        0x4c: 3,    # L NNN     left margin
+        0x75: 3,    # u NNN     one tab stop
+        0x67: 3,    # g NNN     graphics, NNN x 8 bytes
+        0x52: 3,    # R NNN c   repeat character
+        0x48: 4,    # H NNNN    page length
+        0x46: 4,    # F NNNN    place print head
+        0x47: 4,    # G NNNN    graphics, NNNN bytes
+        0x53: 4,    # S NNNN    graphics, NNNN bytes
+        0x56: 4,    # V NNNN c  repeat dot column
+        0x61: 1,    # a N       font
+        0x6c: 1,    # l N       CR/LF
+        0x4b: 1,    # K N       color
+        0x73: 1,    # s N       dot spacing
+    }
+
+    # graphics opcodes, and how many data bytes per count
+    escGraphics = {
+        0x47: 1,
+        0x53: 1,
+        0x67: 8,
+    }
+
+    def __init__( self, sink = None, escLengths = None ):
+        self.sink = sink
+
+        # sequence lengths (including the opcode), indexed by opcode
+        if escLengths == None:
+            escLengths = [ 0 if entry == None else entry[0]
+                for entry in IWProtocolHandler.BuildEscDispatch() ]
+        self.escLengths = escLengths
+
+        self.position = 0           # bytes of the stream decoded so far
+        self.Reset()
+
+    def __call__( self ):
+        return self
+
+    def Reset( self ):
+        """ forget any partial sequence """
+        self.escRemaining = 0       # bytes left in the escape sequence, -1 for "opcode next"
+        self.escSequence = bytearray()
+        self.gfxRemaining = 0       # graphics bytes left to collect
+        self.gfxOpcode = 0
+        self.gfxBuffer = bytearray()
+
+    def Snapshot( self ):
+        """ the partial sequence, if any, in a form that json can store """
+        return {
+            'escRemaining'  : self.escRemaining,
+            'escSequence'   : base64.b64encode( self.escSequence ).decode( 'ascii' ),
+            'gfxRemaining'  : self.gfxRemaining,
+            'gfxOpcode'     : self.gfxOpcode,
+            'gfxBuffer'     : base64.b64encode( self.gfxBuffer ).decode( 'ascii' ),
+        }
+
+    def Restore( self, snapshot ):
+        self.escRemaining = snapshot[ 'escRemaining' ]
+        self.escSequence = bytearray( base64.b64decode( snapshot[ 'escSequence' ] ))
+        self.gfxRemaining = snapshot[ 'gfxRemaining' ]
+        self.gfxOpcode = snapshot[ 'gfxOpcode' ]
+        self.gfxBuffer = bytearray( base64.b64decode( snapshot[ 'gfxBuffer' ] ))
+
+    def Feed( self, data ):
+        """ push API: decode the chunk, and send each event to the sink """
+        sink = self.sink
+        for ev in self.Decode( data ):
+            sink( ev )
+
+    def ParseArgs( self, seq ):
+        """ split the parameters of a complete sequence into a tuple """
+        digits = self.escNumeric.get( seq[0], 0 )
+        args = ()
+        if digits:
+            try:
+                # leading zeroes may be sent as spaces
+                args = ( int( seq[ 1:1+digits ].decode( 'ascii' ).strip() ), )
+            except ValueError:
+                args = ( None, )
+        return args + tuple( seq[ 1+digits: ] )
+
+    def Decode( self, data ):
+        """ generator: decode the chunk, yielding events """
+        controlBytes = self.controlBytes
+        textRun = self.textRun
+        view = memoryview( data )
+        i = 0
+        end = len( data )
+        base = self.position
+
+        while i < end:
+            # graphics data; taken as-is
+            if self.gfxRemaining > 0:
+                n = min( self.gfxRemaining, end - i )
+                payload = view[ i:i+n ]
+                self.gfxRemaining -= n
+                i += n
+
+                if self.gfxRemaining > 0:
+                    # the rest of it is in the next chunk(s)
+                    self.gfxBuffer += payload
+                    continue
+
+                if len( self.gfxBuffer ):
+                    # it came in across chunks; hand out the collected copy
+                    self.gfxBuffer += payload
+                    payload = memoryview( self.gfxBuffer )
+                    self.gfxBuffer = bytearray()
+
+                self.position = base + i
+                yield ( 'gfx', self.gfxOpcode, payload )
+                continue
+
+            # escape sequences
+            if self.escRemaining != 0:
+                if self.escRemaining < 0:
+                    # it's the opcode. now we know how big the thing is.
+                    ch = data[i]
+                    i += 1
+                    length = self.escLengths[ ch ]
+                    if length == 0:
+                        self.escRemaining = 0
+                        self.position = base + i
+                        yield ( 'badesc', ch )
+                        continue
+                    self.escSequence = bytearray( ( ch, ))
+                    self.escRemaining = length - 1
+                else:
+                    n = min( self.escRemaining, end - i )
+                    self.escSequence += data[ i:i+n ]
+                    self.escRemaining -= n
+                    i += n
+
+                if self.escRemaining == 0:
+                    seq = bytes( self.escSequence )
+                    args = self.ParseArgs( seq )
+
+                    # graphics sequences are followed by the dot data
+                    perCount = self.escGraphics.get( seq[0], 0 )
+                    if perCount and args[0]:
+                        self.gfxOpcode = seq[0]
+                        self.gfxRemaining = args[0] * perCount
+
+                    self.position = base + i
+                    yield ( 'esc', seq, args )
+                continue
+
+            ch = data[i]
+            if ch == 0x1b:
+                # start of an escape sequence
+                self.escRemaining = -1
+                i += 1
+
+            elif ch in controlBytes:
+                i += 1
+                self.position = base + i
+                yield ( 'ctrl', ch )
+
+            else:
+                run = textRun.match( data, i )
+                i = run.end()
+                self.position = base + i
+                yield ( 'text', run.group() )
+
+        self.position = base + end
+
+
+class LlamaGunzip( io.RawIOBase ):
+    """ Reads a gzip file, right up to wherever it ends; whether that's
+        the proper end, or the last sync of a capture that's still being
+        written (or that was cut short by a crash).
+    """
+
+    def __init__( self, filename, readSize = 64 * 1024 ):
+        self.file = open( filename, 'rb' )
+        self.readSize = readSize
+        self.inflate = zlib.decompressobj( 16 + zlib.MAX_WBITS )
+        self.pending = b''
+
+    def readable( self ):
+        return True
+
+    def readinto( self, buffer ):
+        while len( self.pending ) == 0:
+            if self.inflate.eof:
+                return 0
+
+            data = self.inflate.unconsumed_tail
+            if len( data ) == 0:
+                data = self.file.read( self.readSize )
+                if len( data ) == 0:
+                    return 0    # ran out; treat it as the end
+            self.pending = self.inflate.decompress( data, len( buffer ))
+
+        n = min( len( buffer ), len( self.pending ))
+        buffer[ :n ] = self.pending[ :n ]
+        self.pending = self.pending[ n: ]
+        return n
+
+    def close( self ):
+        self.file.close()
+        super().close()
+
+
+class LlamaCapture():
+    """ Timed capture file.  Like a .raw, but every chunk that comes in is
+        stored with the time it arrived, along with any serial line changes,
+        so a job can be played back at the speed it was sent.
+
+        File layout:
+            'IWTCAP' + 2 byte version
+            records of:
+                1 byte kind ( b'D' data, b'L' line state 'name=value' )
+                8 byte double, seconds since the capture started
+                4 byte payload length
+                payload
+    """
+
+    magic = b'IWTCAP\x00\x01'
+    recordHeader = struct.Struct( '<cdI' )
+
+    def __init__( self, filename = None ):
+        self.filename = filename
+        self.file = None
+        self.start = 0
+
+        if not filename == None:
+            self.Open( filename )
+
+    def __call__( self ):
+        return self
+
+    @staticmethod
+    def OpenFile( filename, mode = 'rb', **kwargs ):
+        """ open any capture file; .gz ones are (de)compressed on the fly """
+        if not filename.endswith( '.gz' ):
+            return open( filename, mode, **kwargs )
+
+        if 'w' in mode:
+            return gzip.open( filename, mode, compresslevel=6, **kwargs )
+
+        # reading; a capture that's still open (or never got closed) has
+        # no gzip trailer yet, which gzip.open() won't read up to.
+        reader = io.BufferedReader( LlamaGunzip( filename ))
+        if 't' in mode:
+            return io.TextIOWrapper( reader, **kwargs )
+        return reader
+
+    @staticmethod
+    def Split( filename ):
+        """ 'dir/name.raw.gz' -> ( 'dir/name', '.raw' ) """
+        if filename.endswith( '.gz' ):
+            filename = filename[ :-3 ]
+        return os.path.splitext( filename )
+
+    def Open( self, filename ):
+        self.filename = filename
+        self.file = self.OpenFile( filename, 'wb' )
+        self.file.write( self.magic )
+        self.start = time.monotonic()
+
+    def Record( self, kind, payload, when = None ):
+        """ when is the time.monotonic() it happened at; default is now """
+        if self.file == None:
+            return
+        if when == None:
+            when = time.monotonic()
+        self.file.write( self.recordHeader.pack( kind, when - self.start, len( payload )))
+        self.file.write( payload )
+
+    def Data( self, data, when = None ):
+        self.Record( b'D', data, when )
+
+    @staticmethod
+    def SyncFile( file ):
+        """ get everything written so far onto the disk """
+        if isinstance( file, gzip.GzipFile ):
+            # finish the compressed block, so a reader can get up to here
+            file.flush( zlib.Z_SYNC_FLUSH )
+        else:
+            file.flush()
+        os.fsync( file.fileno() )
+
+    def Sync( self ):
+        if not self.file == None:
+            self.SyncFile( self.file )
+
+    def Line( self, name, value ):
+        self.Record( b'L', '{}={}'.format( name, int( value )).encode( 'ascii' ))
+
+    def Close( self ):
+        if self.file == None:
+            return
+        self.file.close()
+        self.file = None
+
+    @classmethod
+    def DataChunks( cls, filename, chunkSize = 64 * 1024 ):
+        """ generator of just the captured bytes from any kind of capture
+            file; .raw, .iwt (this) or .hex """
+        ext = cls.Split( filename )[1]
+
+        if ext == '.iwt':
+            for kind, seconds, payload in cls.Records( filename ):
+                if kind == b'D':
+                    yield payload
+
+        elif ext == '.hex':
+            yield from LlamaHexDump.Chunks( filename, chunkSize )
+
+        else:
+            with cls.OpenFile( filename, 'rb' ) as file:
+                while True:
+                    chunk = file.read( chunkSize )
+                    if not chunk:
+                        return
+                    yield chunk
+
+    @classmethod
+    def Records( cls, filename ):
+        """ generator of ( kind, seconds, payload ) from a capture file """
+        with cls.OpenFile( filename, 'rb' ) as file:
+            if not file.read( len( cls.magic )) == cls.magic:
+                raise ValueError( '{}: not a timed capture'.format( filename ))
+
+            while True:
+                header = file.read( cls.recordHeader.size )
+                if len( header ) < cls.recordHeader.size:
+                    return  # end of file (or a truncated record)
 
+                kind, seconds, length = cls.recordHeader.unpack( header )
+                payload = file.read( length )
+                if len( payload ) < length:
+                    return
+
+                yield ( kind, seconds, payload )
+
+
+class LlamaHexDump():
+    """ Reads the hex dumps that ConnectionTest.py prints, back into bytes.
+
+            1b 3c 1b 4e 1b 41 1b 66   1b 41 1b 66 0f 1b 4e 1b      .<.N.A.f .A.f..N.
+
+        Up to 16 bytes a line, then the ASCII for them.  The dumps were
+        printed from two threads, so now and then the idle timer's padding
+        lands in the middle of a line, or a line gets split in two.  The
+        ASCII column always matches the bytes on its line though, so that
+        is used to tell where the hex stops and the ASCII starts.
+    """
+
+    hexToken = re.compile( r'\S+' )
+    isHex = re.compile( r'[0-9a-fA-F]{2}$' )
+
+    # how each byte shows up in the ASCII column
+    asciiTable = bytes( ch if 0x20 <= ch < 0x7f else 0x2e for ch in range( 256 ))
 
+    def __call__( self ):
+        return self
+
+    @classmethod
+    def DecodeLine( cls, line ):
+        """ the bytes from one line of the dump """
+        line = line.rstrip()
+
+        # the hex bytes are the leading two-digit tokens
+        tokens = []
+        for token in cls.hexToken.finditer( line ):
+            if len( tokens ) == 16 or not cls.isHex.match( token.group() ):
+                break
+            tokens.append( token )
+
+        # but some ASCII columns look like hex too; find the split where
+        # the rest of the line is the ASCII for the bytes before it.
+        for k in range( len( tokens ), 0, -1 ):
+            data = bytes( int( token.group(), 16 ) for token in tokens[ :k ] )
+            text = data.translate( cls.asciiTable ).decode( 'ascii' )
+            if k > 8:
+                text = text[ :8 ] + ' ' + text[ 8: ]
+            text = text.rstrip()
+
+            tail = line[ tokens[ k-1 ].end(): ]
+            if tail.endswith( text ) and tail[ :len( tail ) - len( text ) ].strip() == '':
+                return data
+
+        # doesn't check out; take what looks like hex
+        return bytes( int( token.group(), 16 ) for token in tokens )
+
+    @classmethod
+    def Chunks( cls, filename, chunkSize = 64 * 1024 ):
+        """ generator of the dump's bytes, about chunkSize at a time """
+        chunk = bytearray()
+        with LlamaCapture.OpenFile( filename, 'rt', encoding='latin-1' ) as file:
+            for line in file:
+                chunk += cls.DecodeLine( line )
+                if len( chunk ) >= chunkSize:
+                    yield bytes( chunk )
+                    chunk = bytearray()
+
+        if len( chunk ):
+            yield bytes( chunk )
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -359,10 +1599,22 @@ class IWProtocolHandler( serial.threaded.Protocol ):
     #   When printer buffer space < 266, printer sends ^S (XOFF)
     #   when printer buffer space > 337, printer sends ^Q (XON)
     #   - this might be why MacWrite prints fail... it expects XONs?
+    #   (see LlamaFlowControl, which does all of this)
+
+    # shared escape sequence dispatch table; see BuildEscDispatch()
+    escDispatchTable = None
+
+    # held while picking a capture's name and moving it there, since
+    # captures can be finishing on several threads at once
+    filing = threading.RLock()
+
+    # names handed out by GetNewName, which may not be filed yet
+    namesTaken = set()
 
     def __init__( self, globalConfig ):
         self.config = globalConfig
         self.printout = LlamaPrintout( globalConfig )
+        self.raster = LlamaRaster( globalConfig )
         self.audio = None
 
         self.count = 0
@@ -371,98 +1623,41 @@ class IWProtocolHandler( serial.threaded.Protocol ):
 
         self.serialport = None
 
+        # torn off pages get finished on here, if it's set; see TearOffPage()
+        self.spooler = None
+        self.spooled = []
+
         self.rawFile = None
-        self.fSize = 0
+        self.fSize = 0              # bytes in the current capture
 
-        # esc - escaped 
-        self.escRemaining = 0        # number of chars left in escape sequence
-        # if it's 0, pass characters through...
-        self.escIdx = 0
-        self.escSequence = self.ClearEscapeSequence()
+        # captures get synced to disk in groups; see WriteCapture()
+        self.captureLock = threading.RLock()
+        self.syncTimer = None
+        self.unsynced = 0
+
+        # timed capture, and the last seen state of the serial lines
+        self.capture = LlamaCapture()
+        self.lines = {}
+
+        # page boundaries of the current capture; see StartPageIndex()
+        self.pageMarks = []
+        self.markBase = 0
+
+        # what's in the reprint directory
+        self.reprints = LlamaReprintIndex( globalConfig, self )
+
+        # splits the incoming bytes into text, controls, escapes and graphics
+        self.decoder = IWDecoder()
 
         # current printer state
         self.state = {};
 
-        # Length of escape sequences, based on the first byte; after 0x1b
-        self.eSeqLen = [
-            [ 1, [ # these have no parameters
-                0x6d,   # Select correspondence font
-                0x4d,   # select NLQ font
-
-                0x26,   # mousetext remap
-                0x24,   # ascii
-                # user designed characters
-                0x2d, 0x2b, 0x49, 0x27, 0x2a, 0x24,
-                # character pitch
-                0x6e, 0x4e, 0x45, 0x65, 0x71, 0x51, 0x70, 0x50,
-                # dot spacings
-                0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 
-                # text attributes
-                0x58, 0x59, 0x21, 0x22, 0x77, 0x57, 0x78, 0x79, 0x7a,
-                # head motion
-                0x3e, 0x3c,
-
-                0x30,   # clear all tabs
-
-                0x41,   # 6lpi (default)
-                0x42,   # 8lpi
-
-                0x66,   # forward line feeding (default)
-                0x72,   # reverse line feeding
-                0x76,   # set TOF to current position
-
-                0x4f,   # paper out sensor off
-                0x6f,   # paper out sensor on (default)
-
-                0x63,   # reset to defaults
-
-                0x3f,   # send ident string
-                ]
-            ],
-            [ 2, [ # these have one additional parameter
-                0x73,   # dot spacings
-                0x61,   # select font
-                0x6c,   # CR/LF toggles
-                0x4b,   # Color '0..6': K, Y, M, C, orn(YM), grn(YC), pur(MC)
-                ]
-            ],
-            [ 3, [ # these have two additional parameters
-                0x44,   # clear dips - keyboard, bit select, perf skip
-                0x5a,   # set dipswitches 
-
-                0x54,   # distance between lines NN/144 inch
-                0x67,   # print line of graphics NNNx8 bytes
-                ]
-            ],
-            [ 4, [ # these hsve 3 additional parameters
-                0x4c,   # set left margin  000
-                0x75,   # set one tab stop at HHH
-                ]
-            ],
-            [ 5, [ # these hsve 4 additional parameters
-                0x48,   # set page length 0001-9999
-                0x46,   # place print head NNNN dot cols from left margin
-                0x47,   # print line of graphics NNNN
-                0x53,   # same as 0x47
-                0x52,   # HHHC  repeat charactr c HHH times 000-999
-                ]
-            ],
-            [ 6, [ # these hsve 5 additional parameters
-                ]
-            ],
-            [ 7, [ # these hsve 6 additional parameters
-                0x56,   # print NNNN reps of dot col CC
-                ]
-            ],
-        ]
+        # 256-entry escape sequence dispatch table, indexed by the byte after 0x1b
+        self.escDispatch = self.BuildEscDispatch()
 
-        # exceptions
-        #
-        #   0x1b 0x28 - set multiple tabstops
-        #   0x1b 0x29 - clear multiple tabstops
-        # TODO: handlers for this.
         self.ResetState()
 
+        self.RecoverRawFile()
         self.OpenRawFile()
 
 
@@ -522,6 +1717,14 @@ class IWProtocolHandler( serial.threaded.Protocol ):
 
             "lpi"           : 6,
                 # 6, 8
+            "linespacing"   : 24,
+                # line feed distance, in 1/144"
+
+            "pagelength"    : 1584,
+                # in 1/144" (11 inches)
+
+            "dotspacing"    : 0,
+                # extra dots between proportional characters, 0..9
 
             "leftmargin"    : 0,
 
@@ -544,85 +1747,274 @@ class IWProtocolHandler( serial.threaded.Protocol ):
         };
 
         self.printout.CopyState( self.state )
+        self.raster.UpdateState( self.state )
 
 
     def PowerDown( self ):
         """ do all of the necessfary junk for pilot on the burner """
         self.Play( 'switch' )
-        self.CloseRawFile()
-        self.printout.TearOff()
+        self.FinishSpooled()
 
+        # everything from the page goes under the one name
+        name = self.GetNewName()
+        self.CloseRawFile( name )
+        self.printout.TearOff( name )
+        self.raster.TearOff( name )
 
-    def GetSeqLen( self, firstByte ):
-        """ Go through the table above, and find the matching opcode.
-            If we found it in the list, return the size byte from that
-            So even if we get an escape code we're not handling, we know
-            how big it is so we can ignore it
-        """
-        for l in self.eSeqLen:
-            for kb in l[1]:
-                if kb == firstByte:
-                    return l[0]
 
-        return 0
+    def FinishSpooled( self ):
+        """ wait for all of our torn off pages to be finished """
+        concurrent.futures.wait( self.spooled )
+        self.spooled = []
+
 
     def GetNewFilename( self, basepath, extension ):
         """ determine the next filename to use """
-        i = 0
+        return '{}{}.{}'.format( basepath, self.GetNewName( basepath ), extension )
+
+    def GetNewName( self, basepath = None ):
+        """ pick the name for the next printout, based on the current time.
+            Its capture, html and png pages all share it, so it has to be
+            free for all of them, and not handed out already to a page
+            that's still being finished """
+        if basepath == None:
+            basepath = self.config[ 'printdir' ]
 
-        # get the integer based on sequential digits
         if not os.path.isdir( basepath ):
             os.makedirs( basepath )
 
-        # get the integer based on current time
-        i = time.time()
+        with self.filing:
+            i = int( time.time() )
+            while self.NameTaken( basepath, '%04d' % i ):
+                i += 1
 
-        while os.path.exists( "%s%04d.%s" % (basepath, i, extension) ):
-            i += 1
+            name = '%04d' % i
+            self.namesTaken.add( basepath + name )
+            return name
 
-        return "%s%04d.%s" % (basepath, i, extension);
+    def NameTaken( self, basepath, name ):
+        """ is NAME in use by any of a printout's files? """
+        if basepath + name in self.namesTaken:
+            return True
+        for ext in [ '.raw', '.raw.gz', '.html', '.png', '-001.png' ]:
+            if os.path.exists( basepath + name + ext ):
+                return True
+        return False
 
     def CloseRawFile( self, renameTo = None ):
         """ close the open file, if any """
+        with self.captureLock:
+            self.CloseRawFileLocked( renameTo )
+
+    def CloseRawFileLocked( self, renameTo ):
         if self.rawFile == None:
             return; # nothing to do
 
-        self.rawFile.close()
-        print( "{}: Ended.  {} bytes stored.".format( self.currentFilename, self.fSize ))
-
-        if self.fSize == 0:
+        self.FinishRawFile( self.DetachRawFile( renameTo ))
+
+    def DetachRawFile( self, renameTo, spool = False ):
+        """ take the open capture away from the handler, with everything
+            FinishRawFile needs to file it.  If spooling, its files are
+            moved aside so a new capture can start right away. """
+        if not self.syncTimer == None:
+            self.syncTimer.cancel()
+            self.syncTimer = None
+
+        raw = {
+            'file'      : self.rawFile,
+            'capture'   : self.capture,
+            'size'      : self.fSize,
+            'filename'  : self.currentFilename,
+            'timed'     : self.currentCapture,
+            'suffix'    : self.captureSuffix,
+            'pages'     : self.pageMarks,
+            'renameTo'  : renameTo,
+        }
+        self.rawFile = None
+        self.capture = LlamaCapture()
+
+        if spool:
+            ticket = LlamaSpooler.Ticket()
+            for key, ext in [ ( 'filename', '.raw' ), ( 'timed', '.iwt' ) ]:
+                spoolName = '{}.Spool-{}{}{}'.format( self.config[ 'tempdir' ], ticket, ext, raw[ 'suffix' ] )
+                if os.path.exists( raw[ key ] ):
+                    os.rename( raw[ key ], spoolName )
+                raw[ key ] = spoolName
+        return raw
+
+    def FinishRawFile( self, raw ):
+        """ close a detached capture, and move it (and its timed capture and
+            page index) into the printout directory """
+        raw[ 'file' ].close()
+        raw[ 'capture' ].Close()
+        print( "{}: Ended.  {} bytes stored.".format( raw[ 'filename' ], raw[ 'size' ] ))
+
+        if raw[ 'size' ] == 0:
             print( "Not keeping empty file." )
-            os.remove( self.currentFilename )
+            os.remove( raw[ 'filename' ] )
+            if os.path.exists( raw[ 'timed' ] ):
+                os.remove( raw[ 'timed' ] )
+            return None
 
-        else:
+        renameTo = raw[ 'renameTo' ]
+        with self.filing:
             # if no filename was passed in, pick a new name. 
             if renameTo == None or len( renameTo ) == 0:
                 # generate a new one (has directory name on it)
-                nfn = self.GetNewFilename( self.config[ 'printdir' ], 'raw' )
+                nfn = self.GetNewFilename( self.config[ 'printdir' ], 'raw' + raw[ 'suffix' ] )
             else:
                 # prepend the directory name
-                nfn = '{}{}.raw'.format( self.config[ 'printdir' ], renameTo )
+                nfn = '{}{}.raw{}'.format( self.config[ 'printdir' ], renameTo, raw[ 'suffix' ] )
 
-            os.rename( self.currentFilename, nfn )
-            print( "--> renamed to {}".format( nfn ))
+            os.rename( raw[ 'filename' ], nfn )
+        print( "--> renamed to {}".format( nfn ))
+
+        # share the storage with any identical capture
+        cache = LlamaRenderCache( self.config )
+        if cache.enabled:
+            cache.Dedup( nfn, cache.Hash( nfn )[0] )
+
+        # the timed capture and page index go along with it
+        if os.path.exists( raw[ 'timed' ] ):
+            os.rename( raw[ 'timed' ],
+                LlamaCapture.Split( nfn )[0] + '.iwt' + raw[ 'suffix' ] )
+        self.WritePageIndex( nfn, raw[ 'pages' ], raw[ 'size' ] )
+        return nfn
 
     def OpenRawFile( self ):
         """ open a new file for logging """
-        self.currentFilename = '{}.CURRENT.raw'.format( self.config[ 'printdir' ] )
+        # captures are compressed as they're written, if so configured
+        self.captureSuffix = '.gz' if self.config[ 'compresscaptures' ] else ''
+
+        self.currentFilename = '{}.CURRENT.raw{}'.format( self.config[ 'tempdir' ], self.captureSuffix )
+        self.currentCapture = '{}.CURRENT.iwt{}'.format( self.config[ 'tempdir' ], self.captureSuffix )
 
         print("\n{}: Starting new page".format( self.currentFilename ))
-        self.rawFile = open( self.currentFilename, "wb" ) 
+        self.rawFile = LlamaCapture.OpenFile( self.currentFilename, "wb" ) 
+        self.fSize = 0
+        self.unsynced = 0
+        self.StartPageIndex()
+
+        if self.config[ 'timedcapture' ]:
+            self.capture.Open( self.currentCapture )
+            # start off with the lines as they are now
+            for name, value in self.lines.items():
+                self.capture.Line( name, value )
+
+
+
+    def RecoverRawFile( self ):
+        """ keep anything left over from a capture that never got closed
+            (we crashed, or the power went out), or that was torn off but
+            never finished by the spooler """
+        tempdir = self.config[ 'tempdir' ]
+        leftovers = [ '.CURRENT.raw', '.CURRENT.raw.gz' ]
+        if os.path.isdir( tempdir ):
+            leftovers += sorted( f for f in listdir( tempdir )
+                if f.startswith( '.Spool-' ) and LlamaCapture.Split( f )[1] == '.raw' )
+
+        for name in leftovers:
+            leftover = tempdir + name
+            if not os.path.exists( leftover ):
+                continue
+
+            stem, ext = LlamaCapture.Split( leftover )
+            suffix = leftover[ len( stem ) + len( ext ): ]
+            leftoverCapture = stem + '.iwt' + suffix
+            if os.path.getsize( leftover ) == 0:
+                os.remove( leftover )
+                if os.path.exists( leftoverCapture ):
+                    os.remove( leftoverCapture )
+                continue
+
+            name = LlamaCapture.Split( self.GetNewFilename( self.config[ 'printdir' ], 'raw' + suffix ))[0]
+            name = '{}-recovered'.format( name )
+            os.rename( leftover, name + '.raw' + suffix )
+            if os.path.exists( leftoverCapture ):
+                os.rename( leftoverCapture, name + '.iwt' + suffix )
+            print( "{}: Recovered unfinished capture as {}".format( leftover, name + '.raw' + suffix ))
+
+    def WriteCapture( self, data, when = None ):
+        """ log incoming data to the capture files.  They get synced to disk
+            once enough has come in, or soon after the last write, whichever
+            is first; not on every write. """
+        with self.captureLock:
+            if self.rawFile == None:
+                return
 
+            self.rawFile.write( data )
+            self.capture.Data( data, when )
+            self.fSize += len( data )
+            self.unsynced += len( data )
+
+            if self.unsynced >= self.config[ 'capturesyncbytes' ]:
+                self.SyncCapture()
+
+            elif self.syncTimer == None:
+                self.syncTimer = threading.Timer( self.config[ 'capturesync' ], self.SyncCapture )
+                self.syncTimer.daemon = True
+                self.syncTimer.start()
+
+    def RotateCapture( self ):
+        """ once the capture is big enough, carry on in a new file.  This
+            is done after the data has been decoded, so its pages go in
+            this file's index, and the next file's starts right after it. """
+        limit = self.config[ 'capturelimit' ]
+        with self.captureLock:
+            if self.rawFile == None or not limit or self.fSize < limit:
+                return
+
+            print( "{}: {} bytes, starting another".format( self.currentFilename, self.fSize ))
+            self.CloseRawFileLocked( None )
+            self.OpenRawFile()
+
+    def SyncCapture( self ):
+        """ push the capture files out to the disk """
+        with self.captureLock:
+            if not self.syncTimer == None:
+                self.syncTimer.cancel()
+                self.syncTimer = None
+
+            if self.rawFile == None or self.unsynced == 0:
+                return
+
+            LlamaCapture.SyncFile( self.rawFile )
+            self.capture.Sync()
+            self.unsynced = 0
 
 
     def TearOffPage( self, renameFilename = None ):
-        """ tear off the existing page, and start a new one """
-        self.CloseRawFile( renameFilename )
-        self.OpenRawFile()
+        """ tear off the existing page, and start a new one.  With a spooler,
+            the old page is just moved aside here, and finished (closed,
+            filed, and the html and png completed) on the spooler's
+            threads, so the next job can start coming in right away.
+            Like everything else on the handler, this has to be called on
+            the thread that feeds it data (see IWSerialReader.Call) """
+        # the capture, html and png all go under the one name
+        if renameFilename == None or len( renameFilename ) == 0:
+            renameFilename = self.GetNewName()
+
+        if self.spooler == None:
+            self.CloseRawFile( renameFilename )
+            self.OpenRawFile()
+            self.Play( 'tear' )
+            self.printout.TearOff( renameFilename )
+            self.raster.TearOff( renameFilename )
+
+        else:
+            with self.captureLock:
+                raw = None
+                if not self.rawFile == None:
+                    raw = self.DetachRawFile( renameFilename, True )
+                self.OpenRawFile()
+            self.Play( 'tear' )
 
-        self.Play( 'tear' )
+            finishers = [ self.printout.Spool( renameFilename ), self.raster.Spool( renameFilename ) ]
+            if not raw == None:
+                finishers.insert( 0, lambda: self.FinishRawFile( raw ))
 
-        self.printout.TearOff( renameFilename )
+            self.spooled = [ job for job in self.spooled if not job.done() ]
+            self.spooled.append( self.spooler.Submit( finishers ))
 
         if self.tick == 0: # TODO: remove this.
             self.FlushLine()
@@ -631,34 +2023,49 @@ class IWProtocolHandler( serial.threaded.Protocol ):
 
 
 
-    def DirList( self, thePath, theExt ):
-        theList = []
-        i = 0
-        for f in listdir( thePath ):
-            filename, file_extension = os.path.splitext( f )
-            if file_extension == theExt:
-                theList.append( f )
-                i += 1
+    def PrintList( self ):
+        """ show the first page of the reprint list """
+        self.ListReprints( '' )
 
-        theList.sort()
-        return theList
+    def ListReprints( self, request ):
+        """ show the reprint list.  request is "[PAGE] [TEXT]"; only
+            the captures with TEXT in the name or application are shown """
+        request = request.split( None, 1 )
+        page = 1
+        if len( request ) and request[0].isdigit():
+            page = int( request.pop( 0 ))
+        text = ' '.join( request )
 
-    def PrintList( self, theList ):
-        for i in range( len( theList )):
-            print( "    {:>2}: {}".format( i, theList[i] ))
+        found, pages = self.reprints.Find( text, page )
+        for number, name, entry in found:
+            rendered = ''
+            if entry[ 'rendered' ]:
+                rendered = time.strftime( 'printed %Y-%m-%d %H:%M', time.localtime( entry[ 'rendered' ] ))
+            print( "    {:>2}: {:32} {:>9} bytes {:>4} pg  {:10} {}".format(
+                number, name, entry[ 'size' ], entry[ 'pages' ], entry[ 'app' ] or '?', rendered ))
+        print( "    (page {} of {})".format( min( page, pages ), pages ))
+
+    def ReprintList( self ):
+        """ all of the captures that can be reprinted """
+        return self.reprints.Names()
 
     def Reprint( self, request, logging ):
-        theList = self.DirList( self.config[ 'reprintdir' ], ".raw" )
+        theList = self.ReprintList()
 
         if( request == '' ):
-            print( "No printout chosen.  Usage: r <number>" )
-            self.PrintList( theList )
+            print( "No printout chosen.  Usage: r <number> [speed]" )
+            self.PrintList()
             return;
 
+        # optional playback speed for timed captures
+        speed = 0
+        request = request.split()
         try:
-            request = int( request )
+            if len( request ) > 1:
+                speed = float( request[1] )
+            request = int( request[0] )
         except ValueError:
-            print( "ERROR: {}: Bad number".format( request ))
+            print( "ERROR: {}: Bad number".format( ' '.join( request )))
             pass
             return
 
@@ -669,25 +2076,314 @@ class IWProtocolHandler( serial.threaded.Protocol ):
         rFilename = "{}{}".format( self.config[ 'reprintdir' ], theList[ request ] )
         print( "--- Reprinting {} ---".format( rFilename ))
 
-
-        file = open( rFilename, "rb" )
-        fbyte = file.read(1)
-        while fbyte:
-            if logging:
-                self.data_received( bytes( fbyte ))     # yes logging
-            else :
-                self.HandleByte( int( ord( fbyte )))   # no logging
-            fbyte = file.read(1)
-        file.close()
+        self.ReprintFile( rFilename, logging, speed )
+        self.reprints.Rendered( theList[ request ] )
         print( "\n--- Done reprinting! ---" )
 
 
+    def ReprintFile( self, rFilename, logging, speed = 0, start = 0, stop = None ):
+        """ feed the capture file through, in big chunks.
+            start and stop limit it to that range of the captured bytes.
+            returns the number of bytes fed in.
+        """
+        chunkSize = self.config[ 'reprintchunk' ]
+
+        if logging:
+            handler = self.data_received     # yes logging
+        else:
+            handler = self.HandleData        # no logging
+
+        if LlamaCapture.Split( rFilename )[1] == '.iwt':
+            return self.PlayCapture( rFilename, handler, speed, start, stop )
+
+        if rFilename.endswith( '.gz' ) or LlamaCapture.Split( rFilename )[1] == '.hex':
+            # decompressed (or decoded) as it goes
+            return self.FeedChunks( LlamaCapture.DataChunks( rFilename, chunkSize ), handler, start, stop )
+
+        with open( rFilename, "rb" ) as file:
+            size = os.fstat( file.fileno() ).st_size
+            if not stop == None:
+                size = min( size, stop )
+            if size <= start:
+                return 0
+
+            with mmap.mmap( file.fileno(), 0, access=mmap.ACCESS_READ ) as mapped:
+                for pos in range( start, size, chunkSize ):
+                    handler( mapped[ pos:min( pos + chunkSize, size ) ] )
+
+        return size - start
+
+
+    # --- snapshots
+    #   everything needed to carry on from some point in a capture: the
+    #   printer settings, the head position, and any partly received
+    #   sequence.  They can be taken between any two chunks (or events),
+    #   and are plain dicts that can go straight into json.  The output
+    #   files themselves are not part of it; a restored printer starts
+    #   on fresh ones.
+
+    def Snapshot( self ):
+        """ the emulator state at the current offset into the capture """
+        return {
+            'version'   : 1,
+            'offset'    : self.decoder.position - self.markBase,
+            'state'     : dict( self.state ),
+            'decoder'   : self.decoder.Snapshot(),
+            'raster'    : self.raster.Snapshot(),
+            'printout'  : self.printout.Snapshot(),
+        }
+
+    def Restore( self, snapshot ):
+        """ put everything back the way it was when the snapshot was taken """
+        if not snapshot.get( 'version' ) == 1:
+            raise ValueError( 'unknown snapshot version {}'.format( snapshot.get( 'version' )))
+
+        self.state = dict( snapshot[ 'state' ] )
+        self.decoder.Restore( snapshot[ 'decoder' ] )
+        self.raster.Restore( snapshot[ 'raster' ] )
+        self.raster.UpdateState( self.state )
+        self.printout.Restore( snapshot[ 'printout' ], self.state )
+
+        # offsets from here on carry on from the snapshot's
+        self.markBase = self.decoder.position - snapshot[ 'offset' ]
+
+    def SaveSnapshot( self, filename ):
+        """ write a snapshot out to a file """
+        with open( filename, 'w' ) as snapFile:
+            json.dump( self.Snapshot(), snapFile, separators=( ',', ':' ))
+
+    def LoadSnapshot( self, filename ):
+        """ restore from a snapshot file.  returns the capture offset to resume from """
+        with open( filename ) as snapFile:
+            snapshot = json.load( snapFile )
+        self.Restore( snapshot )
+        return snapshot[ 'offset' ]
+
+    def ReprintFrom( self, rFilename, snapshot, logging, stop = None ):
+        """ restore the snapshot, then carry on with the capture from there """
+        self.Restore( snapshot )
+        return self.ReprintFile( rFilename, logging, 0, snapshot[ 'offset' ], stop )
+
+
+    # --- page index
+    #   a sidecar FILE.raw.idx next to each capture has a snapshot for where
+    #   every page starts, so one page can be reprinted without running
+    #   through all of the ones before it.
+
+    def StartPageIndex( self ):
+        """ start a new index; page 1 starts here """
+        self.markBase = self.decoder.position
+        self.pageMarks = [ self.Snapshot() ]
+
+    def MarkPage( self ):
+        """ a new page starts at the current stream position """
+        self.pageMarks.append( self.Snapshot() )
+
+    def IndexFilename( self, rFilename ):
+        # named for the whole capture name; FILE.raw and FILE.hex each get one
+        return rFilename + '.idx'
+
+    def WritePageIndex( self, rFilename, pageMarks = None, length = None ):
+        """ save the page index for the capture file.  length is how many
+            bytes were captured; a page that starts at the very end (the
+            job ended with a form feed) has nothing on it, so isn't kept """
+        if pageMarks == None:
+            pageMarks = self.pageMarks
+        if not length == None:
+            pageMarks = pageMarks[ :1 ] + [ mark for mark in pageMarks[ 1: ] if mark[ 'offset' ] < length ]
+        stat = os.stat( rFilename )
+        index = {
+            'version'   : 2,
+            'size'      : stat.st_size,
+            'mtime'     : stat.st_mtime_ns,
+            'pages'     : pageMarks,
+        }
+        try:
+            with open( self.IndexFilename( rFilename ), 'w' ) as idxFile:
+                json.dump( index, idxFile, separators=( ',', ':' ))
+        except OSError as e:
+            print( "ERROR: {}: can't write page index: {}".format( rFilename, e ))
+        return index
+
+    def LoadPageIndex( self, rFilename ):
+        """ the page index for the capture file, or None if it's missing or stale """
+        try:
+            with open( self.IndexFilename( rFilename )) as idxFile:
+                index = json.load( idxFile )
+            stat = os.stat( rFilename )
+        except ( OSError, ValueError ):
+            return None
+
+        if not ( index.get( 'version' ) == 2
+                and index[ 'size' ] == stat.st_size
+                and index[ 'mtime' ] == stat.st_mtime_ns ):
+            return None
+        return index
+
+    def BuildPageIndex( self, rFilename ):
+        """ run through the whole capture, with no output, to find the pages """
+        config = copy.deepcopy( self.config )
+        config[ 'raster' ][ 'enabled' ] = False
+        config[ 'timedcapture' ] = False
+        config[ 'cache' ][ 'enabled' ] = False
+        tempdir = tempfile.mkdtemp( prefix='.index-', dir=config[ 'printdir' ] )
+        config[ 'tempdir' ] = tempdir + '/'
+        config[ 'printdir' ] = tempdir + '/'    # what it prints goes nowhere
+
+        try:
+            with open( os.devnull, 'w' ) as quiet, contextlib.redirect_stdout( quiet ):
+                scanner = IWProtocolHandler( config )
+                scanner.ReprintFile( rFilename, False )
+                scanner.PowerDown()
+        finally:
+            shutil.rmtree( tempdir, ignore_errors=True )
+
+        return self.WritePageIndex( rFilename, scanner.pageMarks,
+            scanner.decoder.position - scanner.markBase )
+
+    def ReprintPage( self, request, logging ):
+        """ reprint just one page of a capture. request is "<NUMBER> <PAGE>" """
+        theList = self.ReprintList()
+
+        try:
+            request, page = [ int( v ) for v in request.split() ]
+        except ValueError:
+            print( "Usage: p <number> <page>" )
+            self.PrintList()
+            return
+
+        if( request < 0  or request >= len( theList )):
+            print( "ERROR: {}: Out of range 0..{}".format( request, len( theList )-1))
+            return
+
+        rFilename = "{}{}".format( self.config[ 'reprintdir' ], theList[ request ] )
+
+        index = self.LoadPageIndex( rFilename )
+        if index == None:
+            print( "--- Indexing {} ---".format( rFilename ))
+            index = self.BuildPageIndex( rFilename )
+
+        pages = index[ 'pages' ]
+        if page < 1 or page > len( pages ):
+            print( "ERROR: {}: Page out of range 1..{}".format( page, len( pages )))
+            return
+
+        stop = None
+        if page < len( pages ):
+            stop = pages[ page ][ 'offset' ]
+
+        print( "--- Reprinting {} page {} of {} ---".format( rFilename, page, len( pages )))
+        self.ReprintFrom( rFilename, pages[ page-1 ], logging, stop )
+        self.reprints.Rendered( theList[ request ] )
+        print( "\n--- Done reprinting! ---" )
+
+
+    def FeedChunks( self, chunks, handler, start = 0, stop = None ):
+        """ feed the start..stop range of the stream of chunks to the handler.
+            returns the number of bytes fed in.
+        """
+        size = 0
+        pos = 0
+        for chunk in chunks:
+            first = pos
+            pos += len( chunk )
+            if pos <= start:
+                continue
+            if not stop == None:
+                if first >= stop:
+                    break
+                chunk = chunk[ :stop - first ]
+            chunk = chunk[ max( 0, start - first ): ]
+
+            handler( chunk )
+            size += len( chunk )
+
+        return size
+
+
+    def PlayCapture( self, rFilename, handler, speed = 0, start = 0, stop = None ):
+        """ play back a timed capture.
+            speed 1 is real time, 2 is twice as fast, etc.  0 is as fast
+            as possible.  start and stop limit it to that range of the
+            captured data bytes.  returns the number of bytes fed in.
+        """
+        size = 0
+        pos = 0             # data bytes into the capture
+        began = None        # ( wall clock, capture time ) playback started at
+        played = {}         # the replayed lines, as of this point
+
+        for kind, seconds, payload in LlamaCapture.Records( rFilename ):
+            if kind == b'D':
+                # trim it down to the range we want
+                first = pos
+                pos += len( payload )
+                if pos <= start:
+                    continue
+                if not stop == None:
+                    if first >= stop:
+                        break
+                    payload = payload[ :stop - first ]
+                payload = payload[ max( 0, start - first ): ]
+
+            if speed > 0:
+                if began == None:
+                    began = ( time.monotonic(), seconds )
+                delay = began[0] + ( seconds - began[1] ) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep( delay )
+
+            if kind == b'D':
+                handler( payload )
+                size += len( payload )
+
+            elif kind == b'L':
+                # only shown; the live lines (and what the open capture
+                # records of them) are the serial port's, not the replay's
+                name, value = payload.decode( 'ascii' ).split( '=' )
+                if not played.get( name ) == int( value ):
+                    played[ name ] = int( value )
+                    self.ShowLine( name, int( value ))
+
+        return size
+
+
+    def LineChange( self, name, value ):
+        """ a serial control line changed """
+        if self.lines.get( name ) == value:
+            return
+        self.lines[ name ] = value
+        self.capture.Line( name, value )
+        self.ShowLine( name, value )
+
+    def ShowLine( self, name, value ):
+        self.CmdPrint( "Line {} {}".format( name, "on" if value else "off" ))
+
+
+    def CheckLines( self ):
+        """ look for changes on the serial port's input lines """
+        if self.serialport == None:
+            return
+        try:
+            self.LineChange( 'cts', self.serialport.cts )
+            self.LineChange( 'dsr', self.serialport.dsr )
+            self.LineChange( 'cd', self.serialport.cd )
+        except ( serial.SerialException, AttributeError, NotImplementedError ):
+            pass
+
+
     def TimeTick( self ):
         """ time interval update """
         if self.tick == 0:
             self.FlushLine()
             self.FlushLine()
         self.tick = 1
+        self.Idle()
+
+
+    def Idle( self ):
+        """ called every so often while nothing is coming in """
+        self.CheckLines()
+        self.printout.FlushIfDue()
 
 
     def FlushLine( self ):
@@ -711,10 +2407,6 @@ class IWProtocolHandler( serial.threaded.Protocol ):
         return h
 
 
-    def ClearEscapeSequence( self ):
-        return [ 0, 0, 0, 0, 0, 0 ]
-
-
     def HandleControlCharacter( self, ch ):
         """ try handling a control character
         if we used it, return true
@@ -735,12 +2427,19 @@ class IWProtocolHandler( serial.threaded.Protocol ):
         elif ch == 0x0d or ch == 0x8d:
             self.CmdPrint( "^CR" ) # Carriage Return
             self.printout.Control( 'CR' )
+            self.raster.Control( 'CR' )
         elif ch == 0x0a or ch == 0x8a:
             self.CmdPrint( "^LF/1 line" ) # feed paper one line (LF)
             self.printout.Control( 'LF' )
+            sheet = self.raster.sheet
+            self.raster.Control( 'LF' )
+            if not sheet == self.raster.sheet:
+                self.MarkPage()
         elif ch == 0x0c:
             self.CmdPrint( "^FF/To TOP" ) # Feed to next Top of page 
             self.printout.Control( 'FF' )
+            self.raster.Control( 'FF' )
+            self.MarkPage()
             self.Play( 'ff' )
 
         elif ch == 0x0e: # IW1, IW2
@@ -768,6 +2467,7 @@ class IWProtocolHandler( serial.threaded.Protocol ):
             return False
 
         self.printout.UpdateState( self.state )
+        self.raster.UpdateState( self.state )
         return True
 
 
@@ -775,6 +2475,9 @@ class IWProtocolHandler( serial.threaded.Protocol ):
         """ send back a response to the printing computer """
         if self.serialport == None:
             return
+        # the port only takes bytes
+        if type( txt ) == str:
+            txt = txt.encode( 'ascii' )
         self.serialport.write( txt );
 
 
@@ -787,331 +2490,1358 @@ class IWProtocolHandler( serial.threaded.Protocol ):
         self.state[ field ] = value;
         return
 
-    def HandleEscapeSequence( self, seq ):
-        """ When the code gets to here, we have a completed escape sequence. """
+    # --- escape sequence handlers
+    #   these are all called as handler( self, seq, args, param ) from the
+    #   dispatch table.  seq[0] is the base command, seq[1]..[n] are the raw
+    #   arguments, and args are those parsed by the decoder.
+
+    def EscNote( self, seq, args, text ):
+        """ known sequence, but nothing to do for it (yet) """
+        self.CmdPrint( text )
+
+    def EscStates( self, seq, args, param ):
+        """ simple sequences that just set one or more state fields
+            param is [ text, { field: value, ... } ]
+        """
+        self.CmdPrint( param[0] )
+        for field in param[1]:
+            self.StateChange( field, param[1][ field ] )
+
+    def EscSetNumber( self, seq, args, param ):
+        """ sequences that set a state field to their number
+            param is [ text, field ]
+        """
+        self.CmdPrint( "{} {}".format( param[0], args[0] ))
+        if not args[0] == None:
+            self.StateChange( param[1], args[0] )
 
-        # [0] is the base command. [1]..[5] are arguments.
-        if( seq[0] == 0x63 ): # IW1, IW2
-            self.CmdPrint( "Reset Defaults" )
-            self.ResetState()
-
-        elif( seq[0] == 0x3F ):   
-            self.CmdPrint( "Send ID String" )
-            # IW10CF
-            # | | |+--- Sheet feeder installed
-            # | | +---- Color ribbon in place
-            # | +------ 10 inch carriage
-            # +-------- ImageWriter printer
-
-            if not self.serialport == None:
-                self.SerResponse( "IW10C" ) 
-                # not sure if \n or \r are needed for this. need to test.
-
-        elif( seq[0] == 0x24 ):
-            self.CmdPrint( "Switch to Standard ASCII characters *" )
-            self.StateChange( 'charset', 'ASCII' )
-        elif( seq[0] == 0x26 ):
-            self.CmdPrint( "Remap MouseText To Low Ascii" )
-            self.StateChange( 'charset', 'MouseText' )
-
-        elif( seq[0] == 0x27 ):   self.CmdPrint( "Switch to custom character font" )
-        elif( seq[0] == 0x2a ):   self.CmdPrint( "Switch to custom character font (high vals)" )
-        elif( seq[0] == 0x2b ):   self.CmdPrint( "Max width of custom chars: 16 dots")
-        elif( seq[0] == 0x2d ):   self.CmdPrint( "Max width of custom chars: 8 dots *" )
-        
-        elif( seq[0] == 0x58 ): # IW1, IW2
-            self.CmdPrint( "Start Underline" )
-            self.StateChange( 'underline', True )
-        elif( seq[0] == 0x59 ): # IW1, IW2
-            self.CmdPrint( "Stop Underline *" )
-            self.StateChange( 'underline', False )
-        elif( seq[0] == 0x21 ): # IW1, IW2
-            self.CmdPrint( "Start Bold" )
-            self.StateChange( 'bold', True )
-        elif( seq[0] == 0x22 ): # IW1, IW2
-            self.CmdPrint( "Stop Bold *" )
-            self.StateChange( 'bold', False )
-        elif( seq[0] == 0x77 ):
-            self.CmdPrint( "Start Half-Height" )
-            self.StateChange( 'halfheight', True )
-        elif( seq[0] == 0x57 ):
-            self.CmdPrint( "Stop Half-Height *" )
-            self.StateChange( 'halfheight', False )
-        
-        elif( seq[0] == 0x78 ):
-            self.CmdPrint( "Start Superscript" )
-            self.StateChange( 'superscript', True )
-            self.StateChange( 'subscript', False )
-        elif( seq[0] == 0x79 ):
-            self.CmdPrint( "Start Subscript" )
-            self.StateChange( 'superscript', False )
-            self.StateChange( 'subscript', True )
-        elif( seq[0] == 0x7a ):
-            self.CmdPrint( "Stop Super/Subscript *" )
-            self.StateChange( 'superscript', False )
-            self.StateChange( 'subscript', False )
-        
-
-        elif( seq[0] == 0x6e ): # IW1, IW2
-            # 9 cpi, 72dpi, 576 dots per 8" line
-            self.CmdPrint( "9 cpi - extended" )
-            self.StateChange( 'pitch', 9 )
-        elif( seq[0] == 0x4e ): # IW1, IW2
-            # 10 cpi, 80 dpi, 640
-            self.CmdPrint( "10 cpi - pica" )
-            self.StateChange( 'pitch', 10 )
-        elif( seq[0] == 0x45 ): # IW1, IW2
-            # 12 cpi, 96 dpi, 768 ** default for IW1
-            self.CmdPrint( "12 cpi - elite" )
-            self.StateChange( 'pitch', 12 )
-        elif( seq[0] == 0x70 ): # IW1, IW2
-            # 144 dpi, 1152
-            self.CmdPrint( "144 dpi - pica proportional" )
-            self.StateChange( 'pitch', 144 )
-        elif( seq[0] == 0x50 ): # IW1, IW2
-            # 160 dpi, 1280
-            self.CmdPrint( "160 dpi - elite proportional" )
-            self.StateChange( 'pitch', 160 )
-        elif( seq[0] == 0x65 ): # IW1, IW2
-            # 13.4 cpi, 107 dpi, 856
-            self.CmdPrint( "13.4 cpi - semicondensed" )
-            self.StateChange( 'pitch', 13.4 )
-        elif( seq[0] == 0x71 ): # IW1, IW2
-            # 15 cpi, 120 dpi, 960
-            self.CmdPrint( "15 cpi - condensed" )
-            self.StateChange( 'pitch', 15 )
-        elif( seq[0] == 0x51 ): # IW1, IW2
-            # 17 cpi, 136 dpi, 1088
-            self.CmdPrint( "17 cpi - ultracondensed" )
-            self.StateChange( 'pitch', 17 )
-        
-        
-        elif( seq[0] == 0x41 ): # IW1, IW2
-            self.CmdPrint( "6 lines per inch *" )
-            self.StateChange( 'pitch', 160 )
-        elif( seq[0] == 0x42 ): # IW1, IW2
-            self.CmdPrint( "8 lines per inch" )
-            self.StateChange( 'pitch', 160 )
-        elif( seq[0] == 0x54 ): # IW1, IW2
-            self.CmdPrint( "Distance between lines" )
+    def EscSelect( self, seq, args, param ):
+        """ one parameter byte selects a state value (fonts, colors, etc)
+            param is { paramByte: [ text, field, value ], ... }
+        """
+        sel = param.get( seq[1] )
+        if sel == None:
+            return
+        self.CmdPrint( sel[0] )
+        self.StateChange( sel[1], sel[2] )
+
+    def EscDipSwitches( self, seq, args, param ):
+        """ ESC D / ESC Z - clear or set software dipswitches
+            param is { ( byte1, byte2 ): [ text, field, value ], ... }
+        """
+        sel = param.get( ( seq[1], seq[2] ))
+        if sel == None:
+            # additional ones will set character sets.
+            return
+        self.CmdPrint( sel[0] )
+        self.StateChange( sel[1], sel[2] )
+
+    def EscReset( self, seq, args, param ):
+        self.CmdPrint( "Reset Defaults" )
+        self.ResetState()
+
+    def EscSendId( self, seq, args, param ):
+        self.CmdPrint( "Send ID String" )
+        # IW10CF
+        # | | |+--- Sheet feeder installed
+        # | | +---- Color ribbon in place
+        # | +------ 10 inch carriage
+        # +-------- ImageWriter printer
+
+        if not self.serialport == None:
+            self.SerResponse( b'IW10C' ) 
+            # not sure if \n or \r are needed for this. need to test.
+
+    def EscInsertDots( self, seq, args, param ):
+        # add n dots of space between characters 
+        # "Elite proportional only" - IW1 manual
+        self.CmdPrint( "Insert {} dot spaces".format( seq[0]) )
+
+    def EscPlaceHead( self, seq, args, param ):
+        self.CmdPrint( "Place Print Head {} from left margin".format( args[0] ))
+        if not args[0] == None:
+            self.raster.PlaceHead( args[0] )
+
+    def EscRepeatDots( self, seq, args, param ):
+        # <esc>V0010<byte> prints the dot column 10 times
+        self.CmdPrint( "Print repetitions of dots" )
+        if not args[0] == None:
+            self.raster.Graphics( bytes( ( args[1], )) * args[0] )
+
+
+    @classmethod
+    def BuildEscDispatch( cls ):
+        """ Build (once) the 256-entry table of escape sequences, indexed by
+            the first byte after 0x1b.  Each entry is either None (unknown)
+            or [ length, handler, param ], where length includes the opcode.
+        """
+        if cls.escDispatchTable != None:
+            return cls.escDispatchTable
+
+        note = cls.EscNote
+        states = cls.EscStates
+        select = cls.EscSelect
+        dips = cls.EscDipSwitches
+
+        table = {
+            # these have no parameters
+            0x63: [ 1, cls.EscReset, None ],            # IW1, IW2
+            0x3f: [ 1, cls.EscSendId, None ],
+
+            # character sets
+            0x24: [ 1, states, [ "Switch to Standard ASCII characters *", { 'charset': 'ASCII' } ]],
+            0x26: [ 1, states, [ "Remap MouseText To Low Ascii", { 'charset': 'MouseText' } ]],
+
+            # user designed characters
+            0x27: [ 1, note, "Switch to custom character font" ],
+            0x2a: [ 1, note, "Switch to custom character font (high vals)" ],
+            0x2b: [ 1, note, "Max width of custom chars: 16 dots" ],
+            0x2d: [ 1, note, "Max width of custom chars: 8 dots *" ],
+            0x49: [ 1, note, "Start Load custom characters" ], # ends with 0x04
+
+            # text attributes (IW1, IW2)
+            0x58: [ 1, states, [ "Start Underline", { 'underline': True } ]],
+            0x59: [ 1, states, [ "Stop Underline *", { 'underline': False } ]],
+            0x21: [ 1, states, [ "Start Bold", { 'bold': True } ]],
+            0x22: [ 1, states, [ "Stop Bold *", { 'bold': False } ]],
+            0x77: [ 1, states, [ "Start Half-Height", { 'halfheight': True } ]],
+            0x57: [ 1, states, [ "Stop Half-Height *", { 'halfheight': False } ]],
+            0x78: [ 1, states, [ "Start Superscript",
+                                 { 'superscript': True, 'subscript': False } ]],
+            0x79: [ 1, states, [ "Start Subscript",
+                                 { 'superscript': False, 'subscript': True } ]],
+            0x7a: [ 1, states, [ "Stop Super/Subscript *",
+                                 { 'superscript': False, 'subscript': False } ]],
+
+            # character pitch (IW1, IW2)
+            0x6e: [ 1, states, [ "9 cpi - extended", { 'pitch': 9 } ]],           # 72dpi, 576 dots per 8" line
+            0x4e: [ 1, states, [ "10 cpi - pica", { 'pitch': 10 } ]],             # 80 dpi, 640
+            0x45: [ 1, states, [ "12 cpi - elite", { 'pitch': 12 } ]],            # 96 dpi, 768 ** default for IW1
+            0x70: [ 1, states, [ "144 dpi - pica proportional", { 'pitch': 144 } ]],   # 1152
+            0x50: [ 1, states, [ "160 dpi - elite proportional", { 'pitch': 160 } ]],  # 1280
+            0x65: [ 1, states, [ "13.4 cpi - semicondensed", { 'pitch': 13.4 } ]], # 107 dpi, 856
+            0x71: [ 1, states, [ "15 cpi - condensed", { 'pitch': 15 } ]],        # 120 dpi, 960
+            0x51: [ 1, states, [ "17 cpi - ultracondensed", { 'pitch': 17 } ]],   # 136 dpi, 1088
+
+            # dot spacings
+            0x01: [ 1, cls.EscInsertDots, None ],
+            0x02: [ 1, cls.EscInsertDots, None ],
+            0x03: [ 1, cls.EscInsertDots, None ],
+            0x04: [ 1, cls.EscInsertDots, None ],
+            0x05: [ 1, cls.EscInsertDots, None ],
+            0x06: [ 1, cls.EscInsertDots, None ],
+
+            # head motion (IW1, IW2)
+            0x3e: [ 1, states, [ "Left-to-right printing", { 'printdirection': 'left-to-right' } ]],
+            0x3c: [ 1, states, [ "Bidirectional printing *", { 'printdirection': 'bidirectional' } ]],
+
+            0x30: [ 1, note, "Clear All Tabs" ],
+
+            # line spacing (IW1, IW2)
+            0x41: [ 1, states, [ "6 lines per inch *", { 'lpi': 6, 'linespacing': 24 } ]],
+            0x42: [ 1, states, [ "8 lines per inch", { 'lpi': 8, 'linespacing': 18 } ]],
+
+            # paper motion (IW1, IW2)
+            0x66: [ 1, states, [ "Forward line feeding *", { 'linefeeding': 'forward' } ]],
+            0x72: [ 1, states, [ "Reverse line feeding", { 'linefeeding': 'reverse' } ]],
+            0x76: [ 1, note, "Set TOF to current pos" ],
+
+            0x4f: [ 1, states, [ "Paper out sensor off", { 'paperoutsens': False } ]],
+            0x6f: [ 1, states, [ "Paper out sensor on *", { 'paperoutsens': True } ]],
+
+            # fonts
+            0x6d: [ 1, states, [ "FONT: Correspondence", { 'font': 'correspondence' } ]],
+            0x4d: [ 1, states, [ "FONT: Draft *", { 'font': 'draft' } ]],
+
+            # these have one additional parameter
+            # dot spacing between each character in proportional modes 0..9
+            0x73: [ 2, cls.EscSetNumber, [ "Set dot spacing to", 'dotspacing' ]],
+            0x61: [ 2, select, {
+                0x30: [ "FONT: Correspondence", 'font', 'correspondence' ],
+                0x31: [ "FONT: Draft *", 'font', 'draft' ],
+                0x32: [ "FONT: NLQ", 'font', 'nlq' ],
+                }],
+            0x6c: [ 2, select, {    # IW1, IW2
+                0x30: [ "Insert CR before LF and FF *", 'insCRbeforeLF', True ],
+                0x31: [ "No CR before LF and FF", 'insCRbeforeLF', False ],
+                }],
+            0x4b: [ 2, select, {    # Color '0..6': K, Y, M, C, orn(YM), grn(YC), pur(MC)
+                0x30: [ "Color: Black *", 'color', 'k' ],
+                0x31: [ "Color: Yellow", 'color', 'y' ],
+                0x32: [ "Color: Magenta", 'color', 'm' ],
+                0x33: [ "Color: Cyan", 'color', 'c' ],
+                0x34: [ "Color: Orange (YM)", 'color', 'o' ],
+                0x35: [ "Color: Green (YC)", 'color', 'g' ],
+                0x36: [ "Color: Purple (MC)", 'color', 'p' ],
+                }],
+
+            # these have two additional parameters
+            0x44: [ 3, dips, {      # clear dips - keyboard, bit select, perf skip
+                ( 0x00, 0x20 ): [ "IGNORE 8th data bit *", 'bit8', 'ignore' ],
+                ( 0x01, 0x00 ): [ "Prints unslashed zeroes", 'slashzeroes', False ],
+                ( 0x80, 0x00 ): [ "Add automatic LF after CR", 'insCRbeforeLF', True ],
+                }],
+            0x5a: [ 3, dips, {      # set dipswitches
+                ( 0x00, 0x20 ): [ "INCLUDE 8th data bit", 'bit8', 'observe' ],
+                ( 0x01, 0x00 ): [ "Prints slashed zeroes", 'slashzeroes', True ],
+                ( 0x80, 0x00 ): [ "No LF added after CR", 'insCRbeforeLF', False ],
+                }],
             # set to NN/144 of an inch
             # <ESC>T16 to advance 1 char height down
-            self.StateChange( 'dpl', 99 )
-        
-        elif( seq[0] == 0x66 ): # IW1, IW2
-            self.CmdPrint( "Forward line feeding *" )
-            self.StateChange( 'linefeeding', 'forward' )
-        elif( seq[0] == 0x72 ): # IW1, IW2
-            self.CmdPrint( "Reverse line feeding" )
-            self.StateChange( 'linefeeding', 'reverse' )
-        elif( seq[0] >= 0x31 and seq[0] < 0x3f ):
-            self.CmdPrint( "Feed {} lines blank paper".format( seq[0] - 0x30 ))
-
-        elif( seq[0] == 0x76 ): # IW1, IW2
-            self.CmdPrint( "Set TOF to current pos" )
-        
-        elif( seq[0] == 0x3e ): # IW1, IW2
-            self.CmdPrint( "Left-to-right printing" )
-            self.StateChange( 'printdirection', 'left-to-right' )
-        elif( seq[0] == 0x3c ): # IW1, IW2
-            self.CmdPrint( "Bidirectional printing *" )
-            self.StateChange( 'printdirection', 'bidirectional' )
-        
-        elif( seq[0] == 0x4f ):  # IW1, IW2
-            self.CmdPrint( "Paper out sensor off" )
-            self.StateChange( 'paperoutsens', False )
-        elif( seq[0] == 0x6f ):  # IW1, IW2
-            self.CmdPrint( "Paper out sensor on *" )
-            self.StateChange( 'paperoutsens', True )
-
-        elif( seq[0] == 0x28 ):
-            self.CmdPrint( "Set Tabstops" )
-        elif( seq[0] == 0x75 ):
-            self.CmdPrint( "Set One Tabstop" )
-        elif( seq[0] == 0x29 ):
-            self.CmdPrint( "Clear Tabstops" )
-        elif( seq[0] == 0x30 ):
-            self.CmdPrint( "Clear All Tabs" )
-
-        elif( seq[0] == 0x6c ): # IW1, IW2
-            if( seq[1] == 0x30 ): # IW1, IW2
-                self.CmdPrint( "Insert CR before LF and FF *" )
-                self.StateChange( 'insCRbeforeLF', True )
-            elif( seq[1] == 0x31 ): # IW1, IW2
-                self.CmdPrint( "No CR before LF and FF" )
-                self.StateChange( 'insCRbeforeLF', False )
-
-        elif( seq[0] == 0x49 ):
-            self.CmdPrint( "Start Load custom characters" )
-            # ends with 0x04
-
-        elif( seq[0] == 0x73 ):
-            # dot spacing between each character in proportional modes
-            # 0..9
-            self.CmdPrint( "Set dot spacing to {}".format( seq[1] ))
-
-        elif( seq[0] >= 0x01 and seq[0] <= 0x06 ):
-            # add n dots of space between characters 
-            # "Elite proportional only" - IW1 manual
-            self.CmdPrint( "Insert {} dot spaces".format( seq[0]) )
-
-        elif( seq[0] == 0x46 ):
-            self.CmdPrint( "Place Print Head from left margin" )
-        elif( seq[0] == 0x47 ):
-            self.CmdPrint( "Print a line of graphics" )
-        elif( seq[0] == 0x53 ):
-            self.CmdPrint( "Print a line of graphics" )
-        elif( seq[0] == 0x67 ):
-            self.CmdPrint( "Print a line of graphics *8" )
-        elif( seq[0] == 0x56 ):
-            self.CmdPrint( "Print repetitions of dots" )
-        
-        elif( seq[0] == 0x52 ):
-            # eg <esc>R024*  repeats '*' 24 times
-            #  leading zeros may be replaced with spaces.
-            self.CmdPrint( "Repeat character N times" )
-        
-        elif( seq[0] == 0x61 ):
-            if( seq[1] == 0x30 ):
-                self.CmdPrint( "FONT: Correspondence" )
-                self.StateChange( 'font', 'correspondence' )
-            elif( seq[1] == 0x31 ):
-                self.CmdPrint( "FONT: Draft *" )
-                self.StateChange( 'font', 'draft' )
-            elif( seq[1] ==  0x32 ):
-                self.CmdPrint( "FONT: NLQ" )
-                self.StateChange( 'font', 'nlq' )
-        elif( seq[0] == 0x6d ):
-            self.CmdPrint( "FONT: Correspondence" )
-            self.StateChange( 'font', 'correspondence' )
-        elif( seq[0] == 0x4d ):
-            self.CmdPrint( "FONT: Draft *" )
-            self.StateChange( 'font', 'draft' )
-
-
-        elif( seq[0] == 0x44 ):
-            if( seq[1] == 0x00 and seq[2] == 0x20 ): 
-                self.CmdPrint( "IGNORE 8th data bit *" )
-                self.StateChange( 'bit8', 'ignore' )
-
-            if( seq[1] == 0x01 and seq[2] == 0x00 ): # IW1, IW2
-                self.CmdPrint( "Prints unslashed zeroes" )
-                self.StateChange( 'slashzeroes', False )
-
-            if( seq[1] == 0x80 and seq[2] == 0x00 ): # IW1, IW2
-                self.CmdPrint( "Add automatic LF after CR" )
-                self.StateChange( 'insCRbeforeLF', True )
-
-        elif( seq[0] == 0x5A ):
-            if( seq[1] == 0x00 and seq[2] == 0x20 ):
-                self.CmdPrint( "INCLUDE 8th data bit" )
-                self.StateChange( 'bit8', 'observe' )
-
-            if( seq[1] == 0x01 and seq[2] == 0x00 ): # IW1, IW2
-                self.CmdPrint( "Prints slashed zeroes" )
-                self.StateChange( 'slashzeroes', True )
-
-            if( seq[1] == 0x80 and seq[2] == 0x00 ): # IW1, IW2
-                self.CmdPrint( "No LF added after CR" )
-                self.StateChange( 'insCRbeforeLF', False )
-            # additional ones will set character sets.
+            0x54: [ 3, cls.EscSetNumber, [ "Distance between lines", 'linespacing' ]],
 
-        elif( seq[0] == 0x4c ): # IW1, IW2
+            # these have 3 additional parameters
+            0x67: [ 4, note, "Print a line of graphics *8" ],   # NNNx8 bytes
             # sets to # pixels from left
             # <esc>L035  to 36th character position
-            self.CmdPrint( "Set left margin..." )
-
-        elif( seq[0] == 0x48 ):
-            self.CmdPrint( "Set page length..." )
-
-        elif( seq[0] == 0x4b ):
-            if( seq[1] == 0x30 ): 
-                self.CmdPrint( "Color: Black *" )
-                self.StateChange( 'color', 'k' )
-            elif( seq[1] == 0x31 ): 
-                self.CmdPrint( "Color: Yellow" )
-                self.StateChange( 'color', 'y' )
-            elif( seq[1] == 0x32 ): 
-                self.CmdPrint( "Color: Magenta" )
-                self.StateChange( 'color', 'm' )
-            elif( seq[1] == 0x33 ): 
-                self.CmdPrint( "Color: Cyan" )
-                self.StateChange( 'color', 'c' )
-            elif( seq[1] == 0x34 ): 
-                self.CmdPrint( "Color: Orange (YM)" )
-                self.StateChange( 'color', 'o' )
-            elif( seq[1] == 0x35 ): 
-                self.CmdPrint( "Color: Green (YC)" )
-                self.StateChange( 'color', 'g' )
-            elif( seq[1] == 0x36 ): 
-                self.CmdPrint( "Color: Purple (MC)" )
-                self.StateChange( 'color', 'p' )
+            0x4c: [ 4, note, "Set left margin..." ],
+            0x75: [ 4, note, "Set One Tabstop" ],               # at HHH
+
+            # these have 4 additional parameters
+            0x48: [ 5, cls.EscSetNumber, [ "Set page length", 'pagelength' ]], # 0001-9999 /144"
+            0x46: [ 5, cls.EscPlaceHead, None ],                # NNNN dot cols
+            0x47: [ 5, note, "Print a line of graphics" ],      # NNNN
+            0x53: [ 5, note, "Print a line of graphics" ],      # same as 0x47
+            # eg <esc>R024*  repeats '*' 24 times
+            #  leading zeros may be replaced with spaces.
+            0x52: [ 5, note, "Repeat character N times" ],      # HHHC 000-999
+
+            # these have 5 additional parameters
+            0x56: [ 6, cls.EscRepeatDots, None ],               # NNNN reps of dot col C
+        }
+
+        # exceptions
+        #
+        #   0x1b 0x28 - set multiple tabstops
+        #   0x1b 0x29 - clear multiple tabstops
+        # TODO: handlers for this.
 
+        cls.escDispatchTable = [ None ] * 256
+        for opcode in table:
+            cls.escDispatchTable[ opcode ] = table[ opcode ]
+
+        return cls.escDispatchTable
+
+
+    def HandleEscapeSequence( self, seq, args ):
+        """ When the code gets to here, we have a completed escape sequence. """
+
+        entry = self.escDispatch[ seq[0] ]
+        if entry == None:
+            self.CmdPrint( "UNK ESC: {} \n".format( 
+                ' '.join( self.Hex( ch ) for ch in seq )))
         else:
-            self.CmdPrint( "UNK ESC: {} {} {} {} {} {} \n".format( 
-                self.Hex( seq[0] ), self.Hex( seq[1] ), 
-                self.Hex( seq[2] ), self.Hex( seq[3] ),  
-                self.Hex( seq[4] ), self.Hex( seq[5] ), ))
+            entry[1]( self, seq, args, entry[2] )
 
         self.printout.UpdateState( self.state )
+        self.raster.UpdateState( self.state )
 
 
 
-    def HandleByte( self, ch ):
+    def HandleGraphics( self, opcode, data ):
+        """ a line of graphics dot columns.  data is only valid during the call """
+        self.CmdPrint( "Graphics: {} bytes".format( len( data )))
+        self.raster.Graphics( data )
+
+
+    def HandleEvent( self, ev ):
+        """ act on one event from the decoder """
+        kind = ev[0]
+
+        if kind == 'text':
+            # it's boring content. just output it. or something
+            # (chr() of each byte)
+            self.printout.Write( ev[1].decode( 'latin-1' ))
+            self.raster.Text( ev[1] )
+
+        elif kind == 'ctrl':
+            self.HandleControlCharacter( ev[1] )
+
+        elif kind == 'esc':
+            self.HandleEscapeSequence( ev[1], ev[2] )
+
+        elif kind == 'gfx':
+            self.HandleGraphics( ev[1], ev[2] )
+
+        elif kind == 'badesc':
+            print( "ERROR: Bad Escape sequence {}".format( ev[1] ))
+
+
+    def HandleData( self, data ):
         """ primary valve for the stream of data bytes from the printing computer """
+        self.tick = 0
 
-        self.tick = 0;
-        # python3 - ch is of type 'int'
+        for ev in self.decoder.Decode( data ):
+            self.HandleEvent( ev )
 
-        # filter out high bit
-        #ch = chr( ord( ch ) & 0x7f)
 
-        if self.escRemaining > 0:
-            if self.escRemaining == 999:
-                # it's the first one in the sequence... we need to set it up
-                self.escRemaining = self.GetSeqLen( ch )
-                if self.escRemaining == 0:
-                    # unknown
-                    print( "ERROR: Bad Escape sequence {}".format( ch ))
-                    return
+    def HandleByte( self, ch ):
+        """ handle a single byte (python3 - ch is of type 'int') """
+        self.HandleData( bytes( ( ch, )))
 
-            # we know it, so set it up
-            self.escRemaining = self.escRemaining - 1
-            self.escSequence[ self.escIdx ] = ch
-            self.escIdx = self.escIdx + 1
 
-            # check if we've got the whole expected sequence
-            if self.escRemaining == 0:
-                # yep! hand it off!
-                self.HandleEscapeSequence( self.escSequence )
-        else:
-            if ch == 0x1b: 
-                # it's the start of an escape sequence
-                # prep for accumulating it...
-                self.escRemaining = 999 # determine
-                self.escSequence = self.ClearEscapeSequence()
-                self.escIdx = 0
-
-                # now determine how big the thing is.
-            else:
-                if not self.HandleControlCharacter( ch ):
-                    # it's boring content. just output it. or something
-                    #sys.stdout.write( chr(ch) )
-                    #sys.stdout.flush()
-                    self.printout.Write( chr(ch) )
+    def connection_made( self, transport ):
+        """ the serial reader thread has started """
+        self.serialport = transport.serial
+        self.CheckLines()
 
 
     def data_received(self, data):
         """ input from the serial stream """
+        self.ReceiveData( data )
 
-        # send it to our handler
-        for ch in data:
-            self.HandleByte( ch )
+
+    def ReceiveData( self, data, when = None ):
+        """ input from the serial stream, that arrived at time when """
+
+        # note any line changes before the data that followed them
+        self.CheckLines()
 
         # also log it to the output file
-        if not self.rawFile == None:
-            self.rawFile.write( data )
-            self.fSize += 1
+        self.WriteCapture( data, when )
+
+        # send it to our handler
+        self.HandleData( data )
+
+        # and split the capture, if it's gotten too big
+        self.RotateCapture()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class LlamaSpooler():
+    """ Finishes torn off pages in the background.  TearOffPage moves the
+        page aside and hands the slow part (closing, filing and hashing the
+        capture, the html footer, the end of the png) to here, and the
+        printer carries on.  Each job's parts run in order on one worker;
+        jobs run side by side on the others.
+    """
+
+    # spool file names; unique for this process
+    tickets = itertools.count( 1 )
+
+    def __init__( self, globalConfig ):
+        self.config = globalConfig
+        self.workers = globalConfig[ 'spoolworkers' ]
+        self.pool = concurrent.futures.ThreadPoolExecutor( max_workers=self.workers,
+            thread_name_prefix='IW-spool' )
+
+    def __call__( self ):
+        return self
+
+    @classmethod
+    def Ticket( cls ):
+        return '{}-{}'.format( os.getpid(), next( cls.tickets ))
+
+    def Submit( self, finishers ):
+        """ queue up a job's finishing functions; returns its future """
+        return self.pool.submit( self.Finish, finishers )
+
+    def Finish( self, finishers ):
+        for finisher in finishers:
+            try:
+                finisher()
+            except Exception as e:
+                # keep going; the rest of the job can still be saved
+                print( "ERROR: finishing a page: {}".format( e ))
+
+    def Shutdown( self ):
+        """ finish everything that's queued, then stop """
+        self.pool.shutdown( wait=True )
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class LlamaRingBuffer():
+    """ Fixed size byte ring, between one thread putting bytes in, and
+        another taking them out.  It remembers when each Put() happened,
+        so the taker knows when the bytes arrived.
+
+        When it's full, Put() waits for room.  Close() wakes everyone up;
+        Get() then drains what's left, and returns b'' after that.  Get()
+        also returns b'' if it's given a timeout and nothing came in, or
+        if Wake() was called while it waited.
+    """
+
+    def __init__( self, size, watcher = None ):
+        self.watcher = watcher      # called with the free space as it changes
+        self.ring = bytearray( size )
+        self.size = size
+        self.head = 0               # where the next byte goes in
+        self.count = 0              # bytes waiting
+        self.written = 0            # total bytes put in, ever
+        self.taken = 0              # total bytes taken out, ever
+        self.arrivals = collections.deque()     # [ written, time.monotonic() ] of each Put
+        self.closed = False
+        self.woken = False
+        self.stalls = 0             # times Put() had to wait for room
+        self.cond = threading.Condition()
+
+    def __call__( self ):
+        return self
+
+    def Put( self, data ):
+        """ copy the bytes in, waiting for room if need be """
+        view = memoryview( data )
+        with self.cond:
+            self.arrivals.append( [ self.written, time.monotonic() ] )
+
+            while len( view ) and not self.closed:
+                if self.count == self.size:
+                    self.stalls += 1
+                    self.cond.wait()
+                    continue
+
+                n = min( len( view ), self.size - self.count, self.size - self.head )
+                self.ring[ self.head:self.head + n ] = view[ :n ]
+                self.head = ( self.head + n ) % self.size
+                self.count += n
+                self.written += n
+                view = view[ n: ]
+                self.cond.notify_all()
+
+                if not self.watcher == None:
+                    self.watcher( self.size - self.count )
+
+    def Get( self, maxBytes, timeout = None ):
+        """ wait for some bytes; returns ( bytes, when the first of them arrived ) """
+        with self.cond:
+            while self.count == 0:
+                if self.closed or self.woken:
+                    self.woken = False
+                    return ( b'', None )
+                if not self.cond.wait( timeout ):
+                    return ( b'', None )
+
+            # when did the oldest of these come in?
+            while len( self.arrivals ) > 1 and self.arrivals[1][0] <= self.taken:
+                self.arrivals.popleft()
+            when = self.arrivals[0][1]
+
+            tail = ( self.head - self.count ) % self.size
+            n = min( maxBytes, self.count, self.size - tail )
+            data = bytes( self.ring[ tail:tail + n ] )
+            self.count -= n
+            self.taken += n
+            self.cond.notify_all()
+
+            if not self.watcher == None:
+                self.watcher( self.size - self.count )
+            return ( data, when )
+
+    def Wake( self ):
+        """ get the taker out of Get(), to see to something else """
+        with self.cond:
+            self.woken = True
+            self.cond.notify_all()
+
+    def Close( self ):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class LlamaFlowControl():
+    """ What the real printer does as its input buffer fills up and
+        empties; DTR goes low when it's nearly full, and XOFF is sent a
+        while before that.  Both come back with some hysteresis.  Watch()
+        gets told the free space whenever it changes.
+    """
+
+    XON = b'\x11'
+    XOFF = b'\x13'
+
+    def __init__( self, globalConfig ):
+        self.config = globalConfig[ 'flowcontrol' ]
+        self.port = None
+        self.ready = True           # DTR
+        self.xon = True             # last thing we sent was XON (or nothing)
+        self.lock = threading.Lock()
+
+    def __call__( self ):
+        return self
+
+    def Attach( self, port ):
+        """ start off ready to go """
+        self.port = port
+        if self.config[ 'dtr' ]:
+            self.SetDTR( True )
+
+    def SetDTR( self, ready ):
+        self.ready = ready
+        try:
+            self.port.dtr = ready
+        except ( serial.SerialException, AttributeError, NotImplementedError ):
+            pass
+
+    def Send( self, ch ):
+        try:
+            self.port.write( ch )
+        except serial.SerialException:
+            pass
+
+    def Watch( self, free ):
+        if self.port == None:
+            return
+
+        with self.lock:
+            if self.config[ 'xonxoff' ]:
+                if self.xon and free < self.config[ 'xoff' ]:
+                    self.xon = False
+                    self.Send( self.XOFF )
+                elif not self.xon and free > self.config[ 'xon' ]:
+                    self.xon = True
+                    self.Send( self.XON )
+
+            if self.config[ 'dtr' ]:
+                if self.ready and free < self.config[ 'dtroff' ]:
+                    self.SetDTR( False )
+                elif not self.ready and free > self.config[ 'dtron' ]:
+                    self.SetDTR( True )
+
+
+class IWSerialReader( serial.threaded.Protocol ):
+    """ The protocol for pyserial's ReaderThread.  All the reader thread
+        does is copy the bytes into a ring buffer, so it can always keep
+        the UART drained.  A worker thread takes them back out and does
+        the parsing, rendering, file writing and sounds with them.
+
+        The handler is only ever used from the worker.  Anything else that
+        needs it (tearing off, reprinting) is passed over with Call(), and
+        is run between chunks.
+    """
+
+    def __init__( self, globalConfig, handler ):
+        self.config = globalConfig
+        self.handler = handler
+        self.worker = None
+        self.commands = collections.deque()     # [ future, func, args ] for the worker
+        self.finished = False
+
+        # with flow control, the ring is the printer's input buffer
+        self.flow = None
+        self.drainRate = 0
+        if self.config[ 'flowcontrol' ][ 'enabled' ]:
+            self.flow = LlamaFlowControl( globalConfig )
+            self.drainRate = self.config[ 'flowcontrol' ][ 'drainrate' ]
+            self.ring = LlamaRingBuffer( self.config[ 'flowcontrol' ][ 'buffersize' ], self.flow.Watch )
+        else:
+            self.ring = LlamaRingBuffer( self.config[ 'ringbuffer' ] )
+
+    def __call__( self ):
+        return self
+
+    def connection_made( self, transport ):
+        """ the reader thread has started; start the worker too """
+        self.handler.connection_made( transport )
+        if not self.flow == None:
+            self.flow.Attach( transport.serial )
+        self.worker = threading.Thread( target=self.Work, name='IWParser', daemon=True )
+        self.worker.start()
+
+    def data_received( self, data ):
+        """ (reader thread) just stash it """
+        self.ring.Put( data )
+
+    def connection_lost( self, exc ):
+        """ the reader has stopped; let the worker finish up what's left """
+        self.Stop()
+        if isinstance( exc, Exception ):
+            print( "ERROR: Serial port: {}".format( exc ))
+
+    def Stop( self ):
+        """ no more is coming in; wait for the worker to get through what's
+            in the ring.  (ReaderThread.stop() only waits 2 seconds for
+            connection_lost, so this is called again after it) """
+        self.ring.Close()
+        if not self.worker == None:
+            self.worker.join()
+
+    def Call( self, func, *args ):
+        """ (any thread) have the worker run func( *args ) between chunks;
+            waits for it, and returns what it did.  Once the worker is done,
+            it's just run here. """
+        future = concurrent.futures.Future()
+        with self.ring.cond:
+            if self.worker == None or self.finished:
+                future = None
+            else:
+                self.commands.append( [ future, func, args ] )
+                self.ring.Wake()
+
+        if future == None:
+            return func( *args )
+        return future.result()
+
+    def RunCommands( self ):
+        """ (worker thread) run whatever Call() has queued up """
+        while True:
+            with self.ring.cond:
+                if len( self.commands ) == 0:
+                    return
+                future, func, args = self.commands.popleft()
+            try:
+                future.set_result( func( *args ))
+            except Exception as e:
+                future.set_exception( e )
+
+    def Work( self ):
+        """ (worker thread) feed everything through the handler """
+        chunkSize = self.config[ 'reprintchunk' ]
+        if self.drainRate:
+            # a little at a time, like the print head would
+            chunkSize = max( 1, int( self.drainRate / 20 ))
+        idle = self.config[ 'html' ][ 'flushinterval' ]
+        stalls = 0
+        warned = 0
+        paced = time.monotonic()
+        while True:
+            self.RunCommands()
+            data, when = self.ring.Get( chunkSize, idle )
+            if len( data ) == 0 and self.ring.closed:
+                with self.ring.cond:
+                    self.finished = True
+                self.RunCommands()
+                return
+
+            try:
+                if len( data ) == 0:
+                    # nothing's come in for a while (or there's a command)
+                    if len( self.commands ) == 0:
+                        self.handler.Idle()
+                    continue
+                self.handler.ReceiveData( data, when )
+            except Exception as e:
+                print( "ERROR: {}".format( e ))
+
+            if self.drainRate:
+                # don't take the next bytes out until these would be printed
+                paced = max( paced, when ) + len( data ) / self.drainRate
+                delay = paced - time.monotonic()
+                if delay > 0:
+                    time.sleep( delay )
+
+            # (not more than once a second)
+            if not self.ring.stalls == stalls and time.monotonic() - warned > 1.0:
+                stalls = self.ring.stalls
+                warned = time.monotonic()
+                print( "--- Input buffer full; the serial port had to wait ({})".format( stalls ))
+
+
+class LlamaRenderCache():
+    """ Rendered outputs, filed under a hash of the captured bytes and of
+        everything about the renderer that changes what comes out.  So
+        rendering the same capture again is just linking the files back
+        out, and byte-identical captures share one set of outputs.
+
+        config[ 'cache' ][ 'dir' ] holds:
+            <key>/out.html, out.png, out-001.png, ...   rendered outputs
+            captures/<hash>.raw[.gz]                   our captures, deduplicated
+
+        Only captures we recorded ourselves (FinishRawFile) are
+        deduplicated; the ones rendered from are never touched.
+    """
+
+    def __init__( self, globalConfig ):
+        self.config = globalConfig
+        self.enabled = self.config[ 'cache' ][ 'enabled' ]
+        self.dir = self.config[ 'cache' ][ 'dir' ]
+        self.link = self.config[ 'cache' ][ 'link' ]
+        self.backend = None
+
+    def __call__( self ):
+        return self
+
+    def Backend( self ):
+        """ hash of what the renderers are, and how they're set up """
+        if self.backend == None:
+            backend = { 'renderer' : RENDER_VERSION }
+
+            # html comes out wrapped in the templates
+            templates = hashlib.sha256()
+            for key in [ 'header', 'footer' ]:
+                try:
+                    with open( self.config[ 'html' ][ key ], 'rb' ) as file:
+                        templates.update( file.read() )
+                except OSError:
+                    pass
+            backend[ 'html' ] = templates.hexdigest()
+
+            # png comes out only with numpy, and text on it only with pillow
+            if self.config[ 'raster' ][ 'enabled' ] and not numpy == None:
+                backend[ 'png' ] = self.config[ 'raster' ]
+                try:
+                    import PIL
+                    fonts = [ LlamaGlyphs.FontPath( path )
+                        for path in self.config[ 'raster' ][ 'fonts' ].values() ]
+                    backend[ 'fonts' ] = [ [ path, os.path.getsize( path ) ]
+                        for path in fonts if os.path.exists( path ) ]
+                except ImportError:
+                    pass
+
+            self.backend = hashlib.sha256( json.dumps( backend, sort_keys=True ).encode() ).hexdigest()
+        return self.backend
+
+    def Hash( self, rFilename ):
+        """ ( hash, size ) of the bytes in the capture """
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in LlamaCapture.DataChunks( rFilename, self.config[ 'reprintchunk' ] ):
+            digest.update( chunk )
+            size += len( chunk )
+        return ( digest.hexdigest(), size )
+
+    def Key( self, dataHash ):
+        return hashlib.sha256( '{}:{}'.format( dataHash, self.Backend() ).encode() ).hexdigest()
+
+    def Place( self, src, dest, link ):
+        """ put a copy of src at dest; a hard link if we can """
+        temp = '{}.{}.tmp'.format( dest, os.getpid() )
+        try:
+            if link:
+                try:
+                    os.link( src, temp )
+                except OSError:
+                    shutil.copyfile( src, temp )
+            else:
+                shutil.copyfile( src, temp )
+            os.replace( temp, dest )
+        finally:
+            if os.path.exists( temp ):
+                os.remove( temp )
+
+    def Fetch( self, key, name ):
+        """ put the cached outputs for key out as printdir/name.*
+            returns their filenames, or None if there's nothing cached """
+        if not self.enabled:
+            return None
+
+        entry = '{}{}/'.format( self.dir, key )
+        try:
+            outputs = sorted( listdir( entry ))
+        except OSError:
+            return None
+
+        saved = []
+        for out in outputs:
+            destFilepath = '{}{}{}'.format( self.config[ 'printdir' ], name, out[ len( 'out' ): ] )
+            self.Place( entry + out, destFilepath, self.link )
+            saved.append( destFilepath )
+            print( "Your new printout (cached) is: ", destFilepath )
+
+        # the html needs its stylesheet alongside
+        for fn in self.config[ 'html' ][ 'copyfiles' ]:
+            if not ( os.path.exists( fn[1] ) and filecmp.cmp( fn[0], fn[1], shallow=False )):
+                shutil.copyfile( fn[0], fn[1] )
+
+        return saved
+
+    def Store( self, key, name, outputs ):
+        """ file away the outputs (printdir/name.*) that key rendered to """
+        if not self.enabled:
+            return
+
+        entry = '{}{}/'.format( self.dir, key )
+        if os.path.isdir( entry ):
+            return
+
+        os.makedirs( self.dir, exist_ok=True )
+        temp = tempfile.mkdtemp( prefix='.store-', dir=self.dir )
+        try:
+            prefix = '{}{}'.format( self.config[ 'printdir' ], name )
+            for out in outputs:
+                self.Place( out, '{}/out{}'.format( temp, out[ len( prefix ): ] ), True )
+            os.rename( temp, entry )
+        except OSError:
+            # someone else got it in there first
+            pass
+        finally:
+            shutil.rmtree( temp, ignore_errors=True )
+
+    def Dedup( self, rFilename, dataHash ):
+        """ if an identical capture is already stored, make this a link to it.
+            .raw and .raw.gz are each stored as their own kind; compressed
+            ones are the same if the bytes in them are (the gzip headers
+            differ) """
+        stem, ext = LlamaCapture.Split( rFilename )
+        if not self.enabled or not ext == '.raw':
+            return
+
+        suffix = rFilename[ len( stem ) + len( ext ): ]
+        stored = '{}captures/{}.raw{}'.format( self.dir, dataHash, suffix )
+        try:
+            if not os.path.exists( stored ):
+                os.makedirs( os.path.dirname( stored ), exist_ok=True )
+                os.link( rFilename, stored )
+
+            elif os.path.samefile( stored, rFilename ):
+                pass
+
+            elif suffix == '':
+                if filecmp.cmp( stored, rFilename, shallow=False ):
+                    self.Place( stored, rFilename, True )
+
+            elif self.Hash( stored )[0] == dataHash:
+                self.Place( stored, rFilename, True )
+        except OSError:
+            # no hard links here; just keep the copies
+            pass
+
+
+class LlamaReprintIndex():
+    """ What's in the reprint directory, and what we know about each of
+        the captures in it, kept in config[ 'reprintindex' ] there.  It's
+        only brought up to date when the directory has changed, and then
+        only for the files whose size or mtime have.
+
+        Each entry has:
+            size        bytes in the file
+            mtime       its mtime (ns)
+            pages       how many pages it prints
+            app         the application that printed it (by its habits)
+            hash        sha256 of the captured bytes (see LlamaRenderCache)
+            rendered    time it was last reprinted, or None
+    """
+
+    # the order they get listed in
+    kinds = [ '.raw', '.iwt', '.hex' ]
+
+    # how each application starts off a print job
+    applications = [
+        [ re.compile( rb'\x1b\?\r\x1bo' ),                         'MacWrite' ],
+        [ re.compile( rb'(\x8d\x8a)?(\x1b<)?(\x1bN)?\x1bA\x1bf' ),   'AppleWorks' ],
+        [ re.compile( rb'\r+(\x1bT\d\d\n|\x1b>\x1bP)' ),            'PrintShop' ],
+        [ re.compile( rb'\x18\r' ),                                'CarBuilder' ],
+    ]
+
+    def __init__( self, globalConfig, handler ):
+        self.config = globalConfig
+        self.handler = handler          # for page counts
+        self.dir = self.config[ 'reprintdir' ]
+        self.filename = self.dir + self.config[ 'reprintindex' ]
+        self.entries = None
+        self.names = []
+        self.dirStamp = None
+
+    def __call__( self ):
+        return self
+
+    def Load( self ):
+        try:
+            with open( self.filename ) as idxFile:
+                index = json.load( idxFile )
+            if index.get( 'version' ) == 1:
+                self.entries = index[ 'entries' ]
+                return
+        except ( OSError, ValueError ):
+            pass
+        self.entries = {}
+
+    def Save( self ):
+        temp = '{}.{}.tmp'.format( self.filename, os.getpid() )
+        try:
+            with open( temp, 'w' ) as idxFile:
+                json.dump( { 'version' : 1, 'entries' : self.entries }, idxFile, separators=( ',', ':' ))
+            os.replace( temp, self.filename )
+        except OSError as e:
+            print( "ERROR: {}: can't save: {}".format( self.filename, e ))
+
+        # that changed the directory, but not anything we care about
+        self.dirStamp = os.stat( self.dir ).st_mtime_ns
+
+    def SortKey( self, name ):
+        base, ext = LlamaCapture.Split( name )
+        return ( name.endswith( '.gz' ), self.kinds.index( ext ), name )
+
+    def Application( self, rFilename ):
+        """ guess which program printed it """
+        for chunk in LlamaCapture.DataChunks( rFilename, 256 ):
+            for pattern, name in self.applications:
+                if pattern.match( chunk ):
+                    return name
+            break
+        return None
+
+    def Entry( self, rFilename, stat ):
+        """ all about one capture """
+        dataHash = LlamaRenderCache( self.config ).Hash( rFilename )[0]
+
+        index = self.handler.LoadPageIndex( rFilename )
+        if index == None:
+            with open( os.devnull, 'w' ) as quiet, contextlib.redirect_stdout( quiet ):
+                index = self.handler.BuildPageIndex( rFilename )
+
+        return {
+            'size'      : stat.st_size,
+            'mtime'     : stat.st_mtime_ns,
+            'pages'     : len( index[ 'pages' ] ),
+            'app'       : self.Application( rFilename ),
+            'hash'      : dataHash,
+            'rendered'  : None,
+        }
+
+    def Update( self ):
+        """ bring the index up to date with the directory """
+        if self.entries == None:
+            self.Load()
+
+        try:
+            if os.stat( self.dir ).st_mtime_ns == self.dirStamp:
+                return  # nothing came or went
+        except OSError:
+            return
+
+        changed = False
+        found = {}
+        for dirEntry in os.scandir( self.dir ):
+            if not LlamaCapture.Split( dirEntry.name )[1] in self.kinds \
+                    or not dirEntry.is_file():
+                continue
+
+            stat = dirEntry.stat()
+            entry = self.entries.get( dirEntry.name )
+            if entry == None or not ( entry[ 'size' ] == stat.st_size
+                    and entry[ 'mtime' ] == stat.st_mtime_ns ):
+                print( "--- Indexing {}".format( dirEntry.name ))
+                rendered = None if entry == None else entry[ 'rendered' ]
+                entry = self.Entry( dirEntry.path, stat )
+                entry[ 'rendered' ] = rendered
+                changed = True
+            found[ dirEntry.name ] = entry
+
+        if changed or not len( found ) == len( self.entries ):
+            self.entries = found
+            self.Save()
+        else:
+            self.dirStamp = os.stat( self.dir ).st_mtime_ns
+
+        self.names = sorted( self.entries, key=self.SortKey )
+
+    def Names( self ):
+        """ the captures, in order; the reprint numbers index into this """
+        self.Update()
+        return self.names
+
+    def Find( self, text = '', page = 1 ):
+        """ [ number, name, entry ] of those with text in the name or
+            application, a page at a time.  returns ( found, pages ) """
+        self.Update()
+        text = text.lower()
+
+        found = [ [ number, name, self.entries[ name ] ]
+            for number, name in enumerate( self.names )
+            if text in name.lower() or text in ( self.entries[ name ][ 'app' ] or '' ).lower() ]
+
+        perPage = self.config[ 'reprintpage' ]
+        pages = max( 1, ( len( found ) + perPage - 1 ) // perPage )
+        return ( found[ ( page-1 ) * perPage : page * perPage ], pages )
+
+    def Rendered( self, name ):
+        """ note that it was just reprinted """
+        self.Update()
+        if name in self.entries:
+            self.entries[ name ][ 'rendered' ] = time.time()
+            self.Save()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class LlamaBatch():
+    """ Non-interactive re-rendering of a whole bunch of captures, spread
+        over a pool of processes, one capture per job.
+    """
+
+    def __init__( self, globalConfig, files = None, jobs = None ):
+        self.config = globalConfig
+
+        # no list means everything in the reprint directory.  (hex dumps
+        # too, unless there's a .raw of the same job, which is better)
+        if files == None or len( files ) == 0:
+            names = sorted( listdir( self.config[ 'reprintdir' ] ))
+            files = [ '{}{}'.format( self.config[ 'reprintdir' ], f )
+                for f in names
+                if LlamaCapture.Split( f )[1] == '.raw'
+                or ( LlamaCapture.Split( f )[1] == '.hex'
+                    and not LlamaCapture.Split( f )[0] + '.raw' in names
+                    and not LlamaCapture.Split( f )[0] + '.raw.gz' in names ) ]
+        self.files = files
+        self.jobs = jobs
+
+    def __call__( self ):
+        return self
+
+    @staticmethod
+    def RenderOne( globalConfig, filename ):
+        """ render one capture, in its own temp directory, unless it's
+            already in the render cache.
+            returns [ filename, bytes, seconds, cached ]
+        """
+        config = copy.deepcopy( globalConfig )
+        if not os.path.isdir( config[ 'printdir' ] ):
+            os.makedirs( config[ 'printdir' ], exist_ok=True )
+
+        name = LlamaCapture.Split( os.path.basename( filename ))[0]
+        start = time.monotonic()
+
+        cache = LlamaRenderCache( config )
+        key = None
+        if cache.enabled:
+            # (the capture is only read; it's the user's, not the cache's)
+            dataHash, size = cache.Hash( filename )
+            key = cache.Key( dataHash )
+
+            with open( os.devnull, 'w' ) as quiet, contextlib.redirect_stdout( quiet ):
+                if not cache.Fetch( key, name ) == None:
+                    return [ filename, size, time.monotonic() - start, True ]
+
+        tempdir = tempfile.mkdtemp( prefix='.batch-', dir=config[ 'printdir' ] )
+        config[ 'tempdir' ] = tempdir + '/'
+
+        try:
+            with open( os.devnull, 'w' ) as quiet, contextlib.redirect_stdout( quiet ):
+                handler = IWProtocolHandler( config )
+                size = handler.ReprintFile( filename, False )
+                handler.CloseRawFile()
+                outputs = [ handler.printout.TearOff( name ) ] + handler.raster.TearOff( name )
+        finally:
+            shutil.rmtree( tempdir, ignore_errors=True )
+
+        if not key == None:
+            cache.Store( key, name, [ out for out in outputs if not out == None ] )
+
+        return [ filename, size, time.monotonic() - start, False ]
+
+    def Run( self ):
+        """ render them all, reporting as each one finishes """
+        print( "--- Batch rendering {} captures".format( len( self.files )))
+
+        totalBytes = 0
+        failures = 0
+        start = time.monotonic()
+
+        with concurrent.futures.ProcessPoolExecutor( max_workers=self.jobs ) as pool:
+            futures = { pool.submit( LlamaBatch.RenderOne, self.config, f ): f
+                for f in self.files }
+
+            for future in concurrent.futures.as_completed( futures ):
+                try:
+                    filename, size, seconds, cached = future.result()
+                except Exception as e:
+                    print( " *** ERROR: {}: {}".format( futures[ future ], e ))
+                    failures += 1
+                    continue
+
+                totalBytes += size
+                print( "    {:>10} bytes {:8.3f}s {:>12.0f} bytes/sec  {}{}".format(
+                    size, seconds, size / max( seconds, 1e-6 ), filename,
+                    "  (cached)" if cached else "" ))
+
+        elapsed = time.monotonic() - start
+        print( "--- Done. {} captures, {} bytes in {:.3f}s ({:.0f} bytes/sec), {} failed".format(
+            len( self.files ), totalBytes, elapsed, totalBytes / max( elapsed, 1e-6 ), failures ))
+
+        return failures == 0
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class LlamaVirtualPrinter():
+    """ One of the printers hosted by LlamaServer.  It has its own protocol
+        handler and output directory, and a thread of its own that all of
+        the handler's work is done on (in order), so the event loop never
+        waits on parsing, rendering or files.
+    """
+
+    def __init__( self, globalConfig, name, source, baudrate = 9600 ):
+        self.name = name
+        self.source = source
+        self.baudrate = baudrate
+        self.received = 0
+        self.clients = 0
+        self.closers = []       # things to close when we stop
+        self.pump = None        # the task reading a serial port or pty
+
+        # everything for this printer goes in its own directory
+        self.config = copy.deepcopy( globalConfig )
+        printdir = '{}{}/'.format( globalConfig[ 'printdir' ], name )
+        self.config[ 'printdir' ] = printdir
+        self.config[ 'tempdir' ] = printdir
+        self.config[ 'html' ][ 'copyfiles' ] = [ [ src, printdir + os.path.basename( dest ) ]
+            for src, dest in globalConfig[ 'html' ][ 'copyfiles' ] ]
+        os.makedirs( printdir, exist_ok=True )
+
+        self.pool = concurrent.futures.ThreadPoolExecutor( max_workers=1,
+            thread_name_prefix='IW-{}'.format( name ))
+        self.handler = None
+        self.spooler = None     # shared by all of the printers; see LlamaServer
+        self.jobs = 0
+
+    def __call__( self ):
+        return self
+
+    async def Run( self, func, *args ):
+        """ do something on the printer's own thread """
+        return await asyncio.get_running_loop().run_in_executor( self.pool, func, *args )
+
+    async def Start( self, audio = None ):
+        """ power up, and start listening on the source """
+        loop = asyncio.get_running_loop()
+        source = self.source
+
+        # network printers have no one handler; every connection is a job
+        if source.startswith( 'tcp:' ):
+            await self.Run( self.RecoverJobs )
+            host, _, port = source[ 4: ].rpartition( ':' )
+            server = await asyncio.start_server( self.Client, host or None, int( port ),
+                limit=self.config[ 'reprintchunk' ] )
+            self.closers.append( server )
+            return 'listening on port {}'.format( port )
+
+        self.handler = await self.Run( IWProtocolHandler, self.config )
+        self.handler.audio = audio
+        self.handler.spooler = self.spooler
+
+        if source == 'pty':
+            import tty
+            master, slave = os.openpty()
+            tty.setraw( slave )         # bytes through untouched
+            self.closers.append( os.fdopen( slave, 'rb', buffering=0 ))
+            reader = os.fdopen( master, 'rb', buffering=0 )
+            writer = LlamaPortWriter( lambda data: os.write( master, data ))
+            where = os.ttyname( slave )
+
+        else:
+            port = serial.serial_for_url( source, baudrate=self.baudrate )
+            reader = os.fdopen( os.dup( port.fileno() ), 'rb', buffering=0 )
+            self.closers.append( port )
+            writer = port
+            where = source
+
+        stream = asyncio.StreamReader()
+        transport, protocol = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol( stream ), reader )
+        self.closers.append( transport )
+        self.handler.serialport = writer
+        self.pump = asyncio.ensure_future( self.Pump( stream, self.handler, self.pool ))
+        return 'on {}'.format( where )
+
+    async def Pump( self, stream, handler, pool ):
+        """ everything that comes in goes to the handler.  We don't read
+            more until it's done with the last bit, so a slow printer
+            holds the sender off. """
+        loop = asyncio.get_running_loop()
+        chunkSize = self.config[ 'reprintchunk' ]
+        idle = self.config[ 'html' ][ 'flushinterval' ]
+        while True:
+            try:
+                data = await asyncio.wait_for( stream.read( chunkSize ), idle )
+            except asyncio.TimeoutError:
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                return
+            try:
+                if data == None:
+                    # nothing's come in for a while
+                    await loop.run_in_executor( pool, handler.Idle )
+                else:
+                    self.received += len( data )
+                    await loop.run_in_executor( pool, handler.ReceiveData, data, time.monotonic() )
+            except Exception as e:
+                # one bad chunk shouldn't stop the printer
+                print( "ERROR: {}: {}".format( self.name, e ))
+
+    async def Client( self, reader, writer ):
+        """ a network connection (port 9100 style).  Each one is a job of
+            its own, with its own parser and scratch directory, that gets
+            filed away when the sender hangs up. """
+        self.Keepalive( writer.get_extra_info( 'socket' ))
+        self.clients += 1
+        self.jobs += 1
+
+        config = copy.deepcopy( self.config )
+        config[ 'tempdir' ] = tempfile.mkdtemp( prefix='.job-', dir=self.config[ 'printdir' ] ) + '/'
+        pool = concurrent.futures.ThreadPoolExecutor( max_workers=1,
+            thread_name_prefix='IW-{}-{}'.format( self.name, self.jobs ))
+        loop = asyncio.get_running_loop()
+        print( " >>  {}: job {} from {}".format( self.name, self.jobs, writer.get_extra_info( 'peername' )))
+
+        try:
+            handler = await loop.run_in_executor( pool, IWProtocolHandler, config )
+            handler.spooler = self.spooler
+            handler.serialport = LlamaPortWriter(
+                lambda data: loop.call_soon_threadsafe( writer.write, data ))
+            try:
+                await self.Pump( reader, handler, pool )
+            finally:
+                handler.serialport = None
+                writer.close()
+                await loop.run_in_executor( pool, handler.PowerDown )
+        finally:
+            pool.shutdown()
+            shutil.rmtree( config[ 'tempdir' ], ignore_errors=True )
+            self.clients -= 1
+
+    def RecoverJobs( self ):
+        """ jobs that were still coming in when we last stopped (a crash)
+            left their captures in .job-* directories.  Save what's there,
+            and clear them out. """
+        printdir = self.config[ 'printdir' ]
+        for name in sorted( listdir( printdir )):
+            jobdir = printdir + name + '/'
+            if not ( name.startswith( '.job-' ) and os.path.isdir( jobdir )):
+                continue
+
+            # a handler recovers leftovers in its tempdir as it starts up
+            config = copy.deepcopy( self.config )
+            config[ 'tempdir' ] = jobdir
+            IWProtocolHandler( config ).PowerDown()
+            shutil.rmtree( jobdir, ignore_errors=True )
+
+    @staticmethod
+    def Keepalive( sock ):
+        """ notice quickly when a client goes away without closing: after a
+            second idle, probe every second; three misses and it's gone.
+            (as in tcp_serial_redirect.py) """
+        if sock == None:
+            return
+        try:
+            sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1 )
+            sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1 )
+            sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3 )
+            sock.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
+        except AttributeError:
+            pass # not available on windows
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+
+    async def TearOff( self, filename = None ):
+        if self.handler == None:
+            print( "{}: Network jobs are torn off when the sender hangs up.".format( self.name ))
+            return
+        await self.Run( self.handler.TearOffPage, filename )
+
+    async def Stop( self ):
+        """ stop listening, and power down.  If reading the source failed,
+            that's raised here. """
+        for closer in self.closers:
+            closer.close()
+        try:
+            if not self.pump == None:
+                self.pump.cancel()
+                with contextlib.suppress( asyncio.CancelledError ):
+                    await self.pump
+        finally:
+            if not self.handler == None:
+                await self.Run( self.handler.PowerDown )
+            self.pool.shutdown()
+
+
+class LlamaPortWriter():
+    """ something with a write(), for sending back to the computer """
+
+    def __init__( self, send ):
+        self.send = send
+
+    def __call__( self ):
+        return self
+
+    def write( self, data ):
+        self.send( data )
+
+
+class LlamaServer():
+    """ Host a whole bunch of printers in one process, one event loop. """
+
+    def __init__( self, globalConfig, printers, audio = None, baudrate = 9600 ):
+        self.config = globalConfig
+        self.audio = audio
+        self.printers = []
+
+        # one set of workers finishes the pages for all of the printers
+        self.spooler = None
+        if globalConfig[ 'spoolworkers' ]:
+            self.spooler = LlamaSpooler( globalConfig )
+
+        for spec in printers:
+            name, _, source = spec.partition( '=' )
+            rate = baudrate
+            if '@' in source and not source.startswith( 'tcp:' ):
+                source, _, rate = source.partition( '@' )
+                rate = int( rate )
+            printer = LlamaVirtualPrinter( globalConfig, name, source, rate )
+            printer.spooler = self.spooler
+            self.printers.append( printer )
+
+    def __call__( self ):
+        return self
+
+    def Run( self ):
+        try:
+            asyncio.run( self.Main() )
+        except KeyboardInterrupt:
+            pass
+
+    def Find( self, name ):
+        for printer in self.printers:
+            if printer.name == name:
+                return printer
+        print( "{}: No such printer.".format( name ))
+        return None
+
+    async def Main( self ):
+        if len( self.printers ) == 0:
+            print( "No printers.  Add some with --printer NAME=SOURCE" )
+            return
+
+        for printer in self.printers:
+            try:
+                where = await printer.Start( self.audio )
+                print( " >>  {}: {}, printing to {}".format( printer.name, where, printer.config[ 'printdir' ] ))
+            except ( OSError, serial.SerialException, ValueError ) as e:
+                print( " *** {}: {}: {}".format( printer.name, printer.source, e ))
+
+        print( "\nReady.  [l] list printers, [t NAME] tear off, [q] quit" )
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    cmd = await loop.run_in_executor( None, input, ">: " )
+                except EOFError:
+                    # no console; just keep serving
+                    await asyncio.Event().wait()
+
+                words = cmd.split()
+                if len( words ) == 0:
+                    continue
+
+                if words[0] == 'q':
+                    break
+
+                elif words[0] == 'l':
+                    for printer in self.printers:
+                        print( "    {:12} {:24} {:>10} bytes  {} connected".format(
+                            printer.name, printer.source, printer.received, printer.clients ))
+
+                elif words[0] == 't' and len( words ) > 1:
+                    printer = self.Find( words[1] )
+                    if not printer == None:
+                        await printer.TearOff( ' '.join( words[ 2: ] ) or None )
+
+                else:
+                    print( "{}: Unknown command.".format( cmd ))
+        finally:
+            for printer in self.printers:
+                try:
+                    await printer.Stop()
+                except Exception as e:
+                    print( " *** {}: {}".format( printer.name, e ))
+            if not self.spooler == None:
+                self.spooler.Shutdown()
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -1170,6 +3900,44 @@ class LlamaWriterApp():
             help='Development mode, prints Python internals on errors',
             default=False)
 
+        group = parser.add_argument_group('batch rendering')
+
+        group.add_argument(
+            '--batch',
+            nargs='*',
+            metavar='FILE',
+            help='render the RAW files (default: all in the reprint directory) and exit',
+            default=None)
+
+        group.add_argument(
+            '-j', '--jobs',
+            type=int,
+            help='number of processes for --batch, default: one per cpu',
+            default=None)
+
+        group = parser.add_argument_group('printer server')
+
+        group.add_argument(
+            '--server',
+            action='store_true',
+            help='host many printers at once (see --printer, and config[ \'printers\' ])',
+            default=False)
+
+        group.add_argument(
+            '--printer',
+            action='append',
+            metavar='NAME=SOURCE',
+            help='a printer for --server; SOURCE is a serial port, "pty", or "tcp:PORT"',
+            default=[])
+
+        group.add_argument(
+            '--listen',
+            nargs='?',
+            metavar='[HOST:]PORT',
+            const='',
+            help='take raw print jobs over the network (port 9100 by default); implies --server',
+            default=None)
+
         group = parser.add_argument_group('serial port')
 
         group.add_argument(
@@ -1220,7 +3988,7 @@ class LlamaWriterApp():
         self.args = parser.parse_args()
 
 
-        if not self.args.silent:
+        if not self.args.silent and self.args.batch == None:
             self.audio = LlamaAudio( self.config, True )
             self.audio.Play( 'powerup', True )
         else:
@@ -1273,18 +4041,43 @@ class LlamaWriterApp():
 
         # attach the worker
 
-        self.serial_worker = serial.threaded.ReaderThread( self.ser, self.iw_protocol_handler )
+        # the reader thread only copies bytes to the ring; the handler gets
+        # them on its own thread
+        self.serial_reader = IWSerialReader( self.config, self.iw_protocol_handler )
+        self.serial_worker = serial.threaded.ReaderThread( self.ser, self.serial_reader )
         # ser_to_net = SerialToNet()
         # serial_worker = serial.threaded.ReaderThread(ser, ser_to_net)
-        self.iw_protocol_handler.serialport = serial
         self.iw_protocol_handler.audio = self.audio
         self.serial_worker.start()
 
 
 
+    def Command( self, func, *args ):
+        """ run a console command on the handler.  Online, the parser
+            thread has it, so the command is handed over to there """
+        if self.runmode == 'serial':
+            return self.serial_reader.Call( func, *args )
+        return func( *args )
+
+
     def DoTheThing( self ):
         """ the runloop """
 
+        # batch mode just renders and leaves
+        if not self.args.batch == None:
+            batch = LlamaBatch( self.config, self.args.batch, self.args.jobs )
+            batch.Run()
+            return
+
+        # as does server mode, when it's done
+        if self.args.server or not self.args.listen == None:
+            printers = self.config[ 'printers' ] + self.args.printer
+            if not self.args.listen == None:
+                printers.append( 'net=tcp:{}'.format( self.args.listen or self.config[ 'listenport' ] ))
+            server = LlamaServer( self.config, printers, self.audio, self.args.BAUDRATE )
+            server.Run()
+            return
+
         # if a port was specified, use it.
         if self.args.SERIALPORT is False:
             try:
@@ -1299,6 +4092,12 @@ class LlamaWriterApp():
         self.iw_protocol_handler = IWProtocolHandler( self.config );
         self.iw_protocol_handler.audio = self.audio
 
+        # torn off pages get finished in the background
+        self.spooler = None
+        if self.config[ 'spoolworkers' ]:
+            self.spooler = LlamaSpooler( self.config )
+            self.iw_protocol_handler.spooler = self.spooler
+
         # start either offline (reprint mode) or online (serial mode)
         if os.path.isdir( self.args.SERIALPORT ):
             self.StartOffline()
@@ -1328,19 +4127,28 @@ class LlamaWriterApp():
                         print( "Commands: " )
                         print( "   q          Quit" );
                         print( "   r          List available RAW files to reprint" );
+                        print( "   l<PAGE> <TEXT>  ... a page of them; only those with TEXT in the name/app" );
                         print( "   r<NUMBER>  Reprint the specified captured printout" );
+                        print( "   r<NUMBER> <SPEED>  ... timed (.iwt) capture, 1 = real time, 0 = max" );
+                        print( "   p<NUMBER> <PAGE>   Reprint just one page of it" );
                         print( "   R<NUMBER>  Reprint with RAW logging" );
                         print( "   t          tear off page, saving it based on timestamp" );
                         print( "   t<NAME>   ... or save it as Printouts/<NAME>" );
 
                     elif cmd[0] == "t": # tear off page
-                        self.iw_protocol_handler.TearOffPage( arg )
+                        self.Command( self.iw_protocol_handler.TearOffPage, arg )
 
                     elif cmd[0] == "r": # reprint a file
-                        self.iw_protocol_handler.Reprint( arg, False )
+                        self.Command( self.iw_protocol_handler.Reprint, arg, False )
 
                     elif cmd[0] == "R": # reprint a file
-                        self.iw_protocol_handler.Reprint( arg, True )
+                        self.Command( self.iw_protocol_handler.Reprint, arg, True )
+
+                    elif cmd[0] == "l": # list the reprints
+                        self.Command( self.iw_protocol_handler.ListReprints, arg )
+
+                    elif cmd[0] == "p": # reprint one page of a file
+                        self.Command( self.iw_protocol_handler.ReprintPage, arg, False )
 
                     elif cmd[0] == "q": # quit
                         intentional_exit = True
@@ -1358,12 +4166,15 @@ class LlamaWriterApp():
         except KeyboardInterrupt:
             pass
 
-        # make sure any files are closed
-        self.iw_protocol_handler.PowerDown()
-
-        # shut down the serial worker.
+        # shut down the serial worker. (it finishes off what's in the ring)
         if self.runmode == 'serial':
             self.serial_worker.stop()
+            self.serial_reader.Stop()
+
+        # make sure any files are closed
+        self.iw_protocol_handler.PowerDown()
+        if not self.spooler == None:
+            self.spooler.Shutdown()
 
 
 
@@ -0,0 +1,922 @@
+#!/usr/bin/env python3
+#
+# Tests for LlamaWriter.py
+#
+#   python3 -m pytest -q     (or: python3 -m unittest test_LlamaWriter)
+
+import os
+import copy
+import json
+import asyncio
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+import io
+import re
+import threading
+
+import LlamaWriter
+
+
+here = os.path.dirname( os.path.abspath( __file__ ))
+
+
+class BytePort():
+    """ stands in for a serial.Serial; like it, only takes bytes """
+
+    def __init__( self ):
+        self.sent = b''
+
+    def write( self, data ):
+        if not isinstance( data, ( bytes, bytearray )):
+            raise TypeError( 'unicode strings are not supported, please encode to bytes: {!r}'.format( data ))
+        self.sent += data
+
+
+class LlamaTestCase( unittest.TestCase ):
+    """ each test gets a config of its own, printing into a scratch directory """
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp( prefix='llamatest-' )
+        self.config = copy.deepcopy( LlamaWriter.config )
+        self.config[ 'printdir' ] = self.dir + '/'
+        self.config[ 'tempdir' ] = self.dir + '/'
+        self.config[ 'cache' ][ 'dir' ] = self.dir + '/.cache/'
+        self.config[ 'html' ][ 'header' ] = os.path.join( here, 'Templates', 'PageHeader.shtml' )
+        self.config[ 'html' ][ 'footer' ] = os.path.join( here, 'Templates', 'PageFooter.shtml' )
+        self.config[ 'html' ][ 'copyfiles' ] = []
+        self.config[ 'raster' ][ 'fonts' ] = {}      # png pages are graphics only
+        self.config[ 'reprintdir' ] = self.dir + '/Reprints/'
+        os.makedirs( self.config[ 'reprintdir' ] )
+
+    def tearDown( self ):
+        shutil.rmtree( self.dir, ignore_errors=True )
+
+    def Handler( self, scratch = None ):
+        """ a handler; another one alongside needs a scratch dir of its own """
+        config = self.config
+        if not scratch == None:
+            config = copy.deepcopy( self.config )
+            config[ 'tempdir' ] = '{}/{}/'.format( self.dir, scratch )
+            os.makedirs( config[ 'tempdir' ] )
+        with open( os.devnull, 'w' ) as quiet, contextlib.redirect_stdout( quiet ):
+            return LlamaWriter.IWProtocolHandler( config )
+
+    def Quietly( self, func, *args ):
+        with open( os.devnull, 'w' ) as quiet, contextlib.redirect_stdout( quiet ):
+            return func( *args )
+
+    def Reprint( self, name, data ):
+        """ put a capture in the reprint directory """
+        with open( self.config[ 'reprintdir' ] + name, 'wb' ) as raw:
+            raw.write( data )
+        return self.config[ 'reprintdir' ] + name
+
+    def Html( self, name ):
+        with open( '{}/{}.html'.format( self.dir, name ), 'rb' ) as html:
+            return html.read()
+
+
+class TestResponses( LlamaTestCase ):
+
+    def test_send_id( self ):
+        """ ESC ? gets the printer's ID back, as bytes """
+        handler = self.Handler()
+        port = BytePort()
+        handler.serialport = port
+
+        self.Quietly( handler.ReceiveData, b'Hello\x1b?there\r' )
+        self.assertEqual( port.sent, b'IW10C' )
+
+        self.Quietly( handler.PowerDown )
+
+
+class TestDispatch( LlamaTestCase ):
+
+    def test_lengths( self ):
+        """ each sequence is the opcode plus its parameters """
+        table = LlamaWriter.IWProtocolHandler.BuildEscDispatch()
+        self.assertEqual( len( table ), 256 )
+
+        lengths = { b'c' : 1, b'?' : 1, b'!' : 1, b'N' : 1, b'\x03' : 1,
+            b'a' : 2, b'l' : 2, b'K' : 2, b's' : 2,
+            b'T' : 3, b'D' : 3, b'Z' : 3,
+            b'g' : 4, b'L' : 4, b'u' : 4,
+            b'H' : 5, b'F' : 5, b'G' : 5, b'S' : 5, b'R' : 5,
+            b'V' : 6 }
+        for opcode, length in lengths.items():
+            self.assertEqual( table[ opcode[0] ][0], length, opcode )
+
+        # numbers can't be longer than the sequence
+        for opcode, digits in LlamaWriter.IWDecoder.escNumeric.items():
+            self.assertGreater( table[ opcode ][0], digits, chr( opcode ))
+
+        # multiple tab stops aren't handled yet
+        self.assertIsNone( table[ 0x28 ] )
+        self.assertIsNone( table[ 0x29 ] )
+
+    def test_parameters( self ):
+        """ the parameters are taken, and the next byte is content again """
+        handler = self.Handler()
+        self.Quietly( handler.ReceiveData, b'\x1bT16\x1bH0288\x1ba2\x1bK3\x1bs4X\r' )
+        self.assertEqual( handler.state[ 'linespacing' ], 16 )
+        self.assertEqual( handler.state[ 'pagelength' ], 288 )
+        self.assertEqual( handler.state[ 'font' ], 'nlq' )
+        self.assertEqual( handler.state[ 'color' ], 'c' )
+        self.assertEqual( handler.state[ 'dotspacing' ], 4 )
+        self.Quietly( handler.TearOffPage, 'params' )
+        self.Quietly( handler.PowerDown )
+
+        self.assertIn( b'X', self.Html( 'params' ))
+        self.assertNotIn( b'4X', self.Html( 'params' ))
+
+
+class TestDecoder( unittest.TestCase ):
+
+    stream = ( b'Hello\r\n\x1b!bold\x1b"\x1bT16 \x1b(x\x0c'
+        b'\x1bG0004\x01\x1b\x0d\x80after\x1bg001ABCDEFGH\x1bH0288end\r' )
+
+    def Events( self, chunks ):
+        """ the events for the chunks, with the text runs joined up and
+            the graphics copied out """
+        decoder = LlamaWriter.IWDecoder()
+        events = []
+        for chunk in chunks:
+            for ev in decoder.Decode( chunk ):
+                if ev[0] == 'gfx':
+                    ev = ( 'gfx', ev[1], bytes( ev[2] ))
+                if ev[0] == 'text' and len( events ) and events[-1][0] == 'text':
+                    ev = ( 'text', events.pop()[1] + ev[1] )
+                events.append( ev )
+        self.assertEqual( decoder.position, sum( len( chunk ) for chunk in chunks ))
+        return events
+
+    def test_events( self ):
+        events = self.Events( [ self.stream ] )
+        self.assertEqual( events[:7], [
+            ( 'text', b'Hello' ), ( 'ctrl', 0x0d ), ( 'ctrl', 0x0a ),
+            ( 'esc', b'!', () ), ( 'text', b'bold' ), ( 'esc', b'"', () ),
+            ( 'esc', b'T16', ( 16, )) ] )
+        self.assertIn( ( 'badesc', 0x28 ), events )
+        self.assertEqual( events[-2:], [ ( 'text', b'end' ), ( 'ctrl', 0x0d ) ] )
+
+    def test_chunk_splits( self ):
+        """ the same events, however the stream is split up """
+        whole = self.Events( [ self.stream ] )
+        for size in [ 1, 2, 3, 5, 7 ]:
+            chunks = [ self.stream[ i:i+size ] for i in range( 0, len( self.stream ), size ) ]
+            self.assertEqual( self.Events( chunks ), whole, size )
+        for cut in range( len( self.stream )):
+            self.assertEqual( self.Events( [ self.stream[ :cut ], self.stream[ cut: ] ] ), whole, cut )
+
+    def test_graphics_payload( self ):
+        """ the dot data is exactly the count's worth of bytes, whatever
+            they are, and comes out of the chunk without a copy """
+        data = b'\x1bG0004\x1b\x0d\x0c\x1bG\x1bg002' + bytes( range( 16 )) + b'\x1bS0000X'
+        events = list( LlamaWriter.IWDecoder().Decode( data ))
+        self.assertEqual( [ ev[0] for ev in events ], [ 'esc', 'gfx', 'text', 'esc', 'gfx', 'esc', 'text' ] )
+
+        self.assertEqual( events[1][1], 0x47 )
+        self.assertEqual( bytes( events[1][2] ), b'\x1b\x0d\x0c\x1b' )
+        self.assertIs( events[1][2].obj, data )
+        self.assertEqual( events[2], ( 'text', b'G' ))
+        self.assertEqual( events[4][1], 0x67 )
+        self.assertEqual( bytes( events[4][2] ), bytes( range( 16 )))
+
+        # ESC S0000 has no data after it
+        self.assertEqual( events[5], ( 'esc', b'S0000', ( 0, )) )
+        self.assertEqual( events[6], ( 'text', b'X' ))
+
+    def test_graphics_across_chunks( self ):
+        """ dot data split over chunks comes out whole, once """
+        decoder = LlamaWriter.IWDecoder()
+        self.assertEqual( [ ev[0] for ev in decoder.Decode( b'\x1bG0006\x01\x02' ) ], [ 'esc' ] )
+        self.assertEqual( list( decoder.Decode( b'\x03\x04' )), [] )
+        events = list( decoder.Decode( b'\x05\x06Z' ))
+        self.assertEqual( bytes( events[0][2] ), b'\x01\x02\x03\x04\x05\x06' )
+        self.assertEqual( events[1], ( 'text', b'Z' ))
+
+    def test_feed( self ):
+        """ the push API gets the same events """
+        events = []
+        decoder = LlamaWriter.IWDecoder( sink=lambda ev: events.append( ev[:2] ))
+        decoder.Feed( b'AB\x1bc\r' )
+        self.assertEqual( events, [ ( 'text', b'AB' ), ( 'esc', b'c' ), ( 'ctrl', 0x0d ) ] )
+
+
+class TestHexDump( LlamaTestCase ):
+
+    def test_same_as_raw( self ):
+        """ the dump decodes to the same bytes as the raw capture of the
+            same print, whatever the chunk size, and compressed too """
+        dump = os.path.join( here, 'Reprints', 'PrintShop_PrinterTest.hex' )
+        with open( os.path.join( here, 'Reprints', 'PrintShop_PrinterTest.raw' ), 'rb' ) as raw:
+            expected = raw.read()
+
+        for chunkSize in [ 1, 7, 64 * 1024 ]:
+            self.assertEqual( b''.join( LlamaWriter.LlamaHexDump.Chunks( dump, chunkSize )), expected )
+
+        with open( dump, 'rb' ) as src, LlamaWriter.LlamaCapture.OpenFile( self.dir + '/dump.hex.gz', 'wb' ) as dest:
+            dest.write( src.read() )
+        self.assertEqual( b''.join( LlamaWriter.LlamaCapture.DataChunks( self.dir + '/dump.hex.gz' )), expected )
+
+    def test_lines( self ):
+        """ the ASCII column tells where the hex stops, even if it looks
+            like hex itself, or the line is short """
+        decode = LlamaWriter.LlamaHexDump.DecodeLine
+        self.assertEqual( decode( '41 42                                                   AB\n' ), b'AB' )
+        self.assertEqual( decode( '1b 3c                                                   .<\n' ), b'\x1b<' )
+        self.assertEqual( decode( '1b 3c 1b 4e 1b 41 1b 66   1b 41 1b 66 0f 1b 4e 1b      .<.N.A.f .A.f..N.\n' ),
+            b'\x1b<\x1bN\x1bA\x1bf\x1bA\x1bf\x0f\x1bN\x1b' )
+        self.assertEqual( decode( '\n' ), b'' )
+
+    def test_reprint( self ):
+        """ a dump reprints the same as its raw capture """
+        for ext in [ 'hex', 'raw' ]:
+            shutil.copyfile( os.path.join( here, 'Reprints', 'PrintShop_PrinterTest.' + ext ),
+                self.config[ 'reprintdir' ] + 'test.' + ext )
+        handler = self.Handler()
+        for ext in [ 'hex', 'raw' ]:
+            self.Quietly( handler.ReprintFile, self.config[ 'reprintdir' ] + 'test.' + ext, False )
+            self.Quietly( handler.TearOffPage, ext )
+        self.Quietly( handler.PowerDown )
+        self.assertEqual( self.Html( 'hex' ), self.Html( 'raw' ))
+
+
+# three pages of text, each ended with a form feed
+threePages = b'PAGE ONE\r\x0cPAGE TWO\r\x0cPAGE THREE\r\x0c'
+
+
+class TestPageIndex( LlamaTestCase ):
+
+    def test_offsets( self ):
+        """ each page starts after a form feed; none at the very end """
+        handler = self.Handler()
+        index = self.Quietly( handler.BuildPageIndex, self.Reprint( 'three.raw', threePages ))
+        self.Quietly( handler.PowerDown )
+
+        self.assertEqual( [ page[ 'offset' ] for page in index[ 'pages' ]], [ 0, 10, 20 ] )
+        self.assertEqual( handler.LoadPageIndex( self.config[ 'reprintdir' ] + 'three.raw' ), index )
+
+    def test_live_capture( self ):
+        """ the index written alongside a live capture """
+        handler = self.Handler()
+        self.Quietly( handler.ReceiveData, threePages )
+        self.Quietly( handler.TearOffPage, 'live' )
+        self.Quietly( handler.PowerDown )
+
+        index = handler.LoadPageIndex( self.dir + '/live.raw.gz' )
+        self.assertEqual( [ page[ 'offset' ] for page in index[ 'pages' ]], [ 0, 10, 20 ] )
+
+    def test_no_stray_printouts( self ):
+        """ indexing doesn't leave anything in the printout directory """
+        handler = self.Handler()
+        before = sorted( os.listdir( self.dir ))
+        self.Quietly( handler.BuildPageIndex, self.Reprint( 'three.raw', threePages ))
+        self.assertEqual( sorted( os.listdir( self.dir )), before )
+        self.Quietly( handler.PowerDown )
+
+    def test_reprint_page( self ):
+        """ just the one page comes out """
+        self.Reprint( 'three.raw', threePages )
+        handler = self.Handler()
+        self.Quietly( handler.ReprintPage, '0 2', False )
+        self.Quietly( handler.TearOffPage, 'two' )
+        self.Quietly( handler.PowerDown )
+
+        html = self.Html( 'two' )
+        self.assertIn( b'PAGE TWO', html )
+        self.assertNotIn( b'PAGE ONE', html )
+        self.assertNotIn( b'PAGE THREE', html )
+
+
+class TestReprintIndex( LlamaTestCase ):
+
+    def test_entries( self ):
+        """ page counts, and the program that printed it """
+        self.Reprint( 'three.raw', threePages )
+        self.Reprint( 'mac.raw', b'\x1b?\r\x1bo' + threePages )
+        handler = self.Handler()
+        before = sorted( os.listdir( self.dir ))
+
+        found, pages = self.Quietly( handler.reprints.Find, '', 1 )
+        self.assertEqual( [ [ name, entry[ 'pages' ], entry[ 'app' ]] for number, name, entry in found ],
+            [ [ 'mac.raw', 3, 'MacWrite' ], [ 'three.raw', 3, None ]] )
+        self.assertEqual( sorted( os.listdir( self.dir )), before )
+
+        found, pages = self.Quietly( handler.reprints.Find, 'macwrite', 1 )
+        self.assertEqual( [ name for number, name, entry in found ], [ 'mac.raw' ] )
+        self.Quietly( handler.PowerDown )
+
+
+class TestSnapshot( LlamaTestCase ):
+
+    def test_round_trip( self ):
+        """ a printer restored from a snapshot (through json) carries on
+            just like the one that took it, even mid escape sequence """
+        first = b'Hello \x1b'
+        rest = b'!bold\x1b" plain\r\x1bG0004\x01\x02\x04\x08 done\r'
+
+        whole = self.Handler()
+        self.Quietly( whole.ReceiveData, first )
+        snapshot = json.loads( json.dumps( whole.Snapshot() ))
+        self.Quietly( whole.ReceiveData, rest )
+        after = whole.Snapshot()
+        self.Quietly( whole.TearOffPage, 'whole' )
+
+        resumed = self.Handler( 'resumed' )
+        resumed.Restore( snapshot )
+        self.assertEqual( resumed.Snapshot(), snapshot )
+        self.Quietly( resumed.ReceiveData, rest )
+        self.assertEqual( resumed.Snapshot()[ 'state' ], after[ 'state' ] )
+        self.Quietly( resumed.TearOffPage, 'resumed' )
+
+        self.Quietly( whole.PowerDown )
+        self.Quietly( resumed.PowerDown )
+        self.assertTrue( self.Html( 'resumed' ).endswith( self.Html( 'whole' ).split( b'Hello ' )[1] ))
+
+
+class TestPlayback( LlamaTestCase ):
+
+    def test_lines_not_recorded( self ):
+        """ a timed capture played back while another is being captured
+            leaves the live lines, and the live capture, alone """
+        played = self.config[ 'reprintdir' ] + 'lines.iwt'
+        capture = LlamaWriter.LlamaCapture( played )
+        capture.Line( 'cts', 1 )
+        capture.Data( b'PLAYED\r' )
+        capture.Line( 'cts', 0 )
+        capture.Close()
+
+        handler = self.Handler()
+        self.Quietly( handler.ReceiveData, b'LIVE\r' )
+        self.assertEqual( self.Quietly( handler.ReprintFile, played, False ), 7 )
+        self.assertEqual( handler.lines, {} )
+        self.Quietly( handler.TearOffPage, 'live' )
+        self.Quietly( handler.PowerDown )
+
+        records = list( LlamaWriter.LlamaCapture.Records( self.dir + '/live.iwt.gz' ))
+        self.assertEqual( [ kind for kind, seconds, payload in records ], [ b'D' ] )
+        self.assertIn( b'PLAYED', self.Html( 'live' ))
+
+
+class TestRaster( LlamaTestCase ):
+
+    def Render( self, name, data ):
+        """ print it, and return the png pages as ( rows, cols, rgb ) arrays """
+        try:
+            from PIL import Image
+        except ImportError:
+            self.skipTest( 'needs Pillow' )
+
+        handler = self.Handler()
+        self.Quietly( handler.ReceiveData, data )
+        pages = self.Quietly( handler.raster.TearOff, name )
+        self.Quietly( handler.PowerDown )
+
+        images = []
+        for page in pages:
+            with Image.open( page ) as image:
+                images.append( LlamaWriter.numpy.asarray( image.convert( 'RGB' )))
+        return images
+
+    def Ink( self, image ):
+        return ( image != 255 ).any( axis=2 )
+
+    def test_dots( self ):
+        """ each byte is a column of 8 dots, LSB at the top, each dot two
+            rows (1/72") tall, stretched out to the 160 dpi grid """
+        pages = self.Render( 'dots', b'\x1bP\x1bG0003\x01\x80\xff\x1bN\x1bG0001\x01\r' )
+        self.assertEqual( len( pages ), 1 )
+        self.assertEqual( pages[0].shape, ( 1584, 1280, 3 ))
+
+        ink = self.Ink( pages[0] )
+        self.assertEqual( ink.sum(), 2 + 2 + 16 + 2 * 2 )
+        self.assertTrue( ink[ 0:2, 0 ].all() )
+        self.assertTrue( ink[ 14:16, 1 ].all() )
+        self.assertTrue( ink[ 0:16, 2 ].all() )
+        self.assertTrue( ink[ 0:2, 3:5 ].all() )
+        self.assertTrue(( pages[0][ ink ] == 0 ).all() )      # black
+
+    def test_pages( self ):
+        """ a form feed starts a new png; the paper motion moves the ink """
+        pages = self.Render( 'pages', b'\x1bP\x1bG0001\x01\x0c\n\n\x1bF0010\x1bG0001\x01\r' )
+        self.assertEqual( len( pages ), 2 )
+        self.assertEqual( list( zip( *self.Ink( pages[0] ).nonzero() )), [ ( 0, 0 ), ( 1, 0 ) ] )
+        self.assertEqual( list( zip( *self.Ink( pages[1] ).nonzero() )), [ ( 48, 10 ), ( 49, 10 ) ] )
+
+
+    def test_band_sizes( self ):
+        """ streaming out through a small band comes out the same """
+        line = b'\x1bP\x1bG0008\x01\x03\x07\x0f\x1f\x3f\x7f\xff\r\n'
+        job = b'\x1bT08' + line * 300 + b'\x1bT24' + line * 10
+        big = self.Render( 'big', job )
+
+        self.config[ 'raster' ][ 'bandrows' ] = 16
+        small = self.Render( 'small', job )
+        self.assertEqual( len( small ), len( big ))
+        for one, two in zip( small, big ):
+            self.assertTrue(( one == two ).all() )
+        self.assertGreater( self.Ink( big[1] ).sum(), 0 )
+
+    def test_banner( self ):
+        """ without page breaks, it's one png, down to the last ink """
+        self.config[ 'raster' ][ 'pagebreaks' ] = False
+        self.config[ 'raster' ][ 'bandrows' ] = 64
+        pages = self.Render( 'banner', b'\x1bP\x1bG0001\x01' + b'\r\n' * 100 + b'\x1bG0001\xff\r' )
+        self.assertEqual( len( pages ), 1 )
+        self.assertEqual( pages[0].shape[:2], ( 2416, 1280 ))
+
+        ink = self.Ink( pages[0] )
+        self.assertEqual( ink.sum(), 2 + 16 )
+        self.assertTrue( ink[ 2400:2416, 0 ].all() )
+
+
+    def test_color_passes( self ):
+        """ the passes over the same dots mix like inks do """
+        pages = self.Render( 'color', b'\x1bP'
+            b'\x1bK1\x1bG0003\xff\xff\x01\r'       # yellow
+            b'\x1bK2\x1bG0002\xff\x0f\r'           # magenta
+            b'\x1bK3\x1bG0001\x0f\r'               # cyan
+            b'\x1bK0\x1bG0003\x00\x00\x01\r'       # black
+            b'\x1bK5\x1bG0004\x00\x00\x00\x01\r' )  # green (YC)
+        page = pages[0]
+        self.assertEqual( tuple( page[ 0, 0 ] ), ( 0, 0, 0 ))         # Y+M+C
+        self.assertEqual( tuple( page[ 8, 0 ] ), ( 255, 0, 0 ))       # Y+M
+        self.assertEqual( tuple( page[ 0, 1 ] ), ( 255, 0, 0 ))
+        self.assertEqual( tuple( page[ 8, 1 ] ), ( 255, 255, 0 ))     # Y
+        self.assertEqual( tuple( page[ 0, 2 ] ), ( 0, 0, 0 ))         # Y+K
+        self.assertEqual( tuple( page[ 0, 3 ] ), ( 0, 255, 0 ))       # Y+C
+        self.assertEqual( tuple( page[ 2, 3 ] ), ( 255, 255, 255 ))
+
+    def test_black_only( self ):
+        """ without the color ribbon, all of the ink is black """
+        self.config[ 'raster' ][ 'color' ] = False
+        pages = self.Render( 'black', b'\x1bP\x1bK1\x1bG0001\x01\x1bK2\x1bG0001\x01\r' )
+        ink = self.Ink( pages[0] )
+        self.assertEqual( ink.sum(), 4 )
+        self.assertTrue(( pages[0][ ink ] == 0 ).all() )
+
+
+class TestFonts( LlamaTestCase ):
+
+    def test_missing_font( self ):
+        """ a missing font is looked for next to the script, warned about
+            once, and Pillow's font used instead """
+        self.config[ 'raster' ][ 'fonts' ] = { 'draft' : 'Fonts/Missing.ttf', 'nlq' : 'Fonts/Missing.ttf' }
+        LlamaWriter.LlamaGlyphs.fontWarned = False
+        glyphs = LlamaWriter.LlamaGlyphs( self.config, 160, 144 )
+        if not glyphs.enabled:
+            self.skipTest( 'needs Pillow' )
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout( out ):
+            draft = glyphs.Font( 'draft' )
+            nlq = glyphs.Font( 'nlq' )
+        self.assertIsNotNone( draft )
+        self.assertIsNotNone( nlq )
+        self.assertEqual( out.getvalue().count( 'Unable to load font' ), 1 )
+        self.assertIn( os.path.join( here, 'Fonts', 'Missing.ttf' ), out.getvalue() )
+        self.assertTrue( glyphs.DotGlyph( 'draft', 'US', 'US', 8, ord( 'H' )).any() )
+
+
+class TestCapture( LlamaTestCase ):
+
+    def Captured( self, filename ):
+        return b''.join( LlamaWriter.LlamaCapture.DataChunks( filename ))
+
+    def test_rotation( self ):
+        """ a big capture carries on in another file, each with the pages
+            that start in it indexed from its own start """
+        self.config[ 'capturelimit' ] = 10
+        handler = self.Handler()
+        for data in [ b'PAGE ONE\r\x0cPAGE TWO\r\x0c', b'PAGE THREE\r', b'\x0c' ]:
+            self.Quietly( handler.ReceiveData, data )
+        self.Quietly( handler.TearOffPage, 'end' )
+        self.Quietly( handler.PowerDown )
+
+        parts = sorted( name for name in os.listdir( self.dir )
+            if name.endswith( '.raw.gz' ) and not name == 'end.raw.gz' ) + [ 'end.raw.gz' ]
+        self.assertEqual( [ self.Captured( self.dir + '/' + part ) for part in parts ],
+            [ b'PAGE ONE\r\x0cPAGE TWO\r\x0c', b'PAGE THREE\r', b'\x0c' ] )
+
+        offsets = [ [ page[ 'offset' ] for page in handler.LoadPageIndex( self.dir + '/' + part )[ 'pages' ]]
+            for part in parts ]
+        self.assertEqual( offsets, [ [ 0, 10 ], [ 0 ], [ 0 ] ] )
+
+        # the part that starts mid page knows where on the paper it is
+        self.assertEqual( handler.LoadPageIndex( self.dir + '/' + parts[1] )[ 'pages' ][0][ 'raster' ][ 'sheet' ], 2 )
+
+    def test_sync( self ):
+        """ the capture gets to the disk once enough has come in, or soon
+            after, and can be read back while it's still open """
+        self.config[ 'capturesyncbytes' ] = 8
+        self.config[ 'capturesync' ] = 60
+        handler = self.Handler()
+        current = handler.currentFilename
+
+        self.Quietly( handler.ReceiveData, b'12345' )
+        self.assertEqual( handler.unsynced, 5 )
+        self.assertIsNotNone( handler.syncTimer )
+
+        self.Quietly( handler.ReceiveData, b'67890' )
+        self.assertEqual( handler.unsynced, 0 )
+        self.assertIsNone( handler.syncTimer )
+        self.assertEqual( self.Captured( current ), b'1234567890' )
+
+        # and the timer gets the rest
+        handler.config[ 'capturesync' ] = 0.05
+        self.Quietly( handler.ReceiveData, b'abc' )
+        for tries in range( 100 ):
+            if handler.unsynced == 0:
+                break
+            time.sleep( 0.01 )
+        self.assertEqual( self.Captured( current ), b'1234567890abc' )
+        self.Quietly( handler.PowerDown )
+
+
+class TestCache( LlamaTestCase ):
+
+    def test_dedup_compressed( self ):
+        """ the same job captured twice, compressed, is stored once """
+        self.config[ 'compresscaptures' ] = True
+        handler = self.Handler()
+        for name in [ 'one', 'two' ]:
+            self.Quietly( handler.ReceiveData, b'Hello there\r\n\x0c' )
+            self.Quietly( handler.TearOffPage, name )
+        self.Quietly( handler.PowerDown )
+
+        one = self.dir + '/one.raw.gz'
+        two = self.dir + '/two.raw.gz'
+        self.assertTrue( os.path.samefile( one, two ))
+        self.assertEqual( b''.join( LlamaWriter.LlamaCapture.DataChunks( two )),
+            b'Hello there\r\n\x0c' )
+
+
+    def test_store_fetch( self ):
+        """ rendering the same capture again comes out of the cache, the
+            same as it went in, and the capture itself is left alone """
+        with open( os.path.join( here, 'Reprints', 'CarBuilder_Report.raw' ), 'rb' ) as raw:
+            job = raw.read()
+        first = self.Reprint( 'first.raw', job )
+        second = self.Reprint( 'second.raw', job )
+
+        # one of ours of the same bytes, already stored
+        handler = self.Handler()
+        self.Quietly( handler.ReceiveData, job )
+        self.Quietly( handler.TearOffPage, 'ours' )
+        self.Quietly( handler.PowerDown )
+
+        render = LlamaWriter.LlamaBatch.RenderOne
+        self.assertFalse( self.Quietly( render, self.config, first )[3] )
+        self.assertTrue( self.Quietly( render, self.config, second )[3] )
+
+        for name in [ 'first', 'second' ]:
+            self.assertEqual( os.stat( self.config[ 'reprintdir' ] + name + '.raw' ).st_nlink, 1 )
+        self.assertEqual( self.Html( 'second' ), self.Html( 'first' ))
+        with open( self.dir + '/first.png', 'rb' ) as one, open( self.dir + '/second.png', 'rb' ) as two:
+            self.assertEqual( one.read(), two.read() )
+
+
+class LinePort( BytePort ):
+    """ a BytePort with a DTR line; remembers what was sent, and when """
+
+    def __init__( self ):
+        BytePort.__init__( self )
+        self.events = []
+        self.line = None
+
+    def write( self, data ):
+        BytePort.write( self, data )
+        self.events.append( data )
+
+    @property
+    def dtr( self ):
+        return self.line
+
+    @dtr.setter
+    def dtr( self, ready ):
+        self.line = ready
+        self.events.append( 'DTR on' if ready else 'DTR off' )
+
+
+class TestFlowControl( LlamaTestCase ):
+
+    def test_watermarks( self ):
+        """ XOFF below 266 free, DTR off below 30, and back on above 100
+            and 337; nothing in between """
+        flow = LlamaWriter.LlamaFlowControl( self.config )
+        port = LinePort()
+        flow.Attach( port )
+        ring = LlamaWriter.LlamaRingBuffer( 2048, flow.Watch )
+        self.assertEqual( port.events, [ 'DTR on' ] )
+
+        def FillTo( free ):
+            ring.Put( b'x' * ( ring.size - ring.count - free ))
+
+        def DrainTo( free ):
+            ring.Get( free - ( ring.size - ring.count ))
+
+        FillTo( 266 )
+        self.assertEqual( port.events, [ 'DTR on' ] )
+        FillTo( 265 )
+        self.assertEqual( port.events[1:], [ b'\x13' ] )
+        FillTo( 30 )
+        self.assertEqual( port.events[1:], [ b'\x13' ] )
+        FillTo( 29 )
+        self.assertEqual( port.events[1:], [ b'\x13', 'DTR off' ] )
+
+        DrainTo( 100 )
+        self.assertEqual( port.events[1:], [ b'\x13', 'DTR off' ] )
+        DrainTo( 101 )
+        self.assertEqual( port.events[1:], [ b'\x13', 'DTR off', 'DTR on' ] )
+        DrainTo( 337 )
+        self.assertEqual( len( port.events ), 4 )
+        DrainTo( 338 )
+        self.assertEqual( port.events[1:], [ b'\x13', 'DTR off', 'DTR on', b'\x11' ] )
+
+        # in between the marks, nothing changes
+        FillTo( 270 )
+        DrainTo( 330 )
+        self.assertEqual( len( port.events ), 5 )
+        self.assertEqual( port.sent, b'\x13\x11' )
+
+    def test_disabled( self ):
+        """ each of them can be turned off """
+        self.config[ 'flowcontrol' ][ 'xonxoff' ] = False
+        flow = LlamaWriter.LlamaFlowControl( self.config )
+        port = LinePort()
+        flow.Attach( port )
+        flow.Watch( 0 )
+        flow.Watch( 2048 )
+        self.assertEqual( port.events, [ 'DTR on', 'DTR off', 'DTR on' ] )
+
+
+class TestSerialReader( LlamaTestCase ):
+
+    def test_stop_drains_ring( self ):
+        """ Stop waits until the worker has handled everything """
+        got = []
+
+        class Slow():
+            def connection_made( self, transport ):
+                pass
+            def ReceiveData( self, data, when ):
+                time.sleep( 0.05 )
+                got.append( data )
+
+        class Transport():
+            serial = BytePort()
+
+        self.config[ 'flowcontrol' ][ 'enabled' ] = False
+        reader = LlamaWriter.IWSerialReader( self.config, Slow() )
+        reader.connection_made( Transport() )
+        for n in range( 5 ):
+            reader.data_received( b'x' * 10 )
+            time.sleep( 0.06 )
+        reader.Stop()
+
+        self.assertFalse( reader.worker.is_alive() )
+        self.assertEqual( sum( len( data ) for data in got ), 50 )
+
+    def test_idle_flush( self ):
+        """ a half-sent line gets to the html once the input goes quiet """
+        self.config[ 'html' ][ 'flushinterval' ] = 0.1
+        handler = self.Handler()
+        reader = LlamaWriter.IWSerialReader( self.config, handler )
+
+        class Transport():
+            serial = BytePort()
+
+        self.Quietly( reader.connection_made, Transport() )
+        time.sleep( 0.2 )
+        reader.data_received( b'Hello ' )   # flushed; it's been a while
+        time.sleep( 0.02 )
+        reader.data_received( b'there' )    # held, and then nothing else comes
+        time.sleep( 0.5 )
+
+        with open( handler.printout.tempFilepath, 'rb' ) as html:
+            self.assertIn( b'Hello there', html.read() )
+
+        reader.Stop()
+        self.Quietly( handler.PowerDown )
+
+
+    def test_commands_on_worker( self ):
+        """ tearing off while a job streams in goes through the worker, so
+            nothing is lost or garbled """
+        with open( os.path.join( here, 'Reprints', 'PrintShop_Poster.raw' ), 'rb' ) as raw:
+            poster = raw.read()
+
+        handler = self.Handler()
+        handler.spooler = LlamaWriter.LlamaSpooler( self.config )
+        reader = LlamaWriter.IWSerialReader( self.config, handler )
+
+        class Transport():
+            serial = BytePort()
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout( output ):
+            reader.connection_made( Transport() )
+
+            def Send():
+                for offset in range( 0, len( poster ), 512 ):
+                    reader.data_received( poster[ offset:offset + 512 ] )
+            sender = threading.Thread( target=Send )
+            sender.start()
+
+            names = []
+            while sender.is_alive():
+                names.append( reader.Call( threading.current_thread ))
+                reader.Call( handler.TearOffPage, 'part{:03}'.format( len( names )))
+            sender.join()
+            reader.Stop()
+            handler.PowerDown()
+            handler.spooler.Shutdown()
+
+        self.assertTrue( all( name == reader.worker for name in names ))
+        self.assertNotIn( 'ERROR', output.getvalue() )
+        self.assertNotIn( 'NO FILE', output.getvalue() )
+
+        # every byte made it into one capture or another
+        captures = sorted( f for f in os.listdir( self.dir ) if f.endswith( '.raw.gz' ))
+        captures = [ f for f in captures if f.startswith( 'part' ) ] + [ f for f in captures if not f.startswith( 'part' ) ]
+        captured = b''.join( b''.join( LlamaWriter.LlamaCapture.DataChunks( self.dir + '/' + name ))
+            for name in captures )
+        self.assertEqual( captured, poster )
+
+
+class TestSpooler( LlamaTestCase ):
+
+    def Render( self, spool ):
+        """ two jobs, torn off; returns { filename : contents } """
+        with open( os.path.join( here, 'Reprints', 'CarBuilder_Report.raw' ), 'rb' ) as raw:
+            jobs = [ raw.read(), threePages ]
+
+        out = '{}/{}/'.format( self.dir, 'spooled' if spool else 'inline' )
+        os.makedirs( out )
+        self.config[ 'printdir' ] = out
+        self.config[ 'tempdir' ] = out
+        handler = self.Handler()
+        if spool:
+            handler.spooler = LlamaWriter.LlamaSpooler( self.config )
+
+        for n, job in enumerate( jobs ):
+            self.Quietly( handler.ReceiveData, job )
+            self.Quietly( handler.TearOffPage, 'job{}'.format( n ))
+        self.Quietly( handler.PowerDown )
+        if spool:
+            handler.spooler.Shutdown()
+
+        outputs = {}
+        for name in os.listdir( out ):
+            if name.endswith( '.gz' ):
+                outputs[ name ] = b''.join( LlamaWriter.LlamaCapture.DataChunks( out + name ))
+            elif not name.endswith( '.idx' ):
+                with open( out + name, 'rb' ) as file:
+                    outputs[ name ] = file.read()
+        return outputs
+
+    def test_all_outputs( self ):
+        """ the spooler finishes everything, the same as doing it inline """
+        inline = self.Render( False )
+        spooled = self.Render( True )
+
+        self.assertEqual( sorted( spooled ), sorted( inline ))
+        self.assertIn( 'job0.png', spooled )
+        for name in [ 'job0.raw.gz', 'job0.html', 'job0.png', 'job1.raw.gz', 'job1.html' ]:
+            self.assertEqual( spooled[ name ], inline[ name ], name )
+        self.assertFalse( any( name.startswith( '.Spool-' ) for name in spooled ))
+
+    def test_one_name( self ):
+        """ an unnamed tear off files the capture, html and png under one
+            name, and the next one doesn't take it """
+        with open( os.path.join( here, 'Reprints', 'CarBuilder_Report.raw' ), 'rb' ) as raw:
+            job = raw.read()
+
+        for spool in [ False, True ]:
+            out = '{}/{}/'.format( self.dir, 'spooled' if spool else 'inline' )
+            os.makedirs( out )
+            self.config[ 'printdir' ] = out
+            self.config[ 'tempdir' ] = out
+            handler = self.Handler()
+            if spool:
+                handler.spooler = LlamaWriter.LlamaSpooler( self.config )
+
+            for n in range( 2 ):
+                self.Quietly( handler.ReceiveData, job )
+                self.Quietly( handler.TearOffPage )
+            self.Quietly( handler.PowerDown )
+            if spool:
+                handler.spooler.Shutdown()
+
+            names = {}
+            for name in os.listdir( out ):
+                if not name.startswith( '.' ) and not name.endswith( '.idx' ):
+                    stem, ext = LlamaWriter.LlamaCapture.Split( name )
+                    names.setdefault( stem, set() ).add( ext )
+            self.assertEqual( len( names ), 2, names )
+            for exts in names.values():
+                self.assertEqual( exts, { '.raw', '.iwt', '.html', '.png' } )
+
+
+class TestServer( LlamaTestCase ):
+
+    def test_pump_survives_errors( self ):
+        """ a chunk the handler chokes on doesn't stop the printer reading """
+        printer = LlamaWriter.LlamaVirtualPrinter( self.config, 'p', 'pty' )
+        got = []
+
+        class Choosy():
+            def ReceiveData( self, data, when ):
+                if data == b'bad':
+                    raise TypeError( 'choked' )
+                got.append( data )
+
+        async def Run():
+            stream = asyncio.StreamReader()
+            pump = asyncio.ensure_future( printer.Pump( stream, Choosy(), printer.pool ))
+            for chunk in [ b'bad', b'good' ]:
+                stream.feed_data( chunk )
+                await asyncio.sleep( 0.1 )
+            stream.feed_eof()
+            await pump
+
+        self.Quietly( asyncio.run, Run() )
+        printer.pool.shutdown()
+        self.assertEqual( got, [ b'good' ] )
+        self.assertEqual( printer.received, 7 )
+
+    def test_recover_jobs( self ):
+        """ a network job cut off by a crash is saved the next time """
+        printer = LlamaWriter.LlamaVirtualPrinter( self.config, 'net', 'tcp:0' )
+        printdir = printer.config[ 'printdir' ]
+        jobdir = tempfile.mkdtemp( prefix='.job-', dir=printdir )
+        with LlamaWriter.LlamaCapture.OpenFile( jobdir + '/.CURRENT.raw.gz', 'wb' ) as raw:
+            raw.write( b'Hello there\r' )
+
+        self.Quietly( printer.RecoverJobs )
+        printer.pool.shutdown()
+
+        self.assertFalse( os.path.exists( jobdir ))
+        recovered = [ f for f in os.listdir( printdir ) if f.endswith( '-recovered.raw.gz' ) ]
+        self.assertEqual( len( recovered ), 1 )
+        self.assertEqual( b''.join( LlamaWriter.LlamaCapture.DataChunks( printdir + recovered[0] )),
+            b'Hello there\r' )
+
+    def test_concurrent_jobs( self ):
+        """ jobs sent at the same time, interleaved, each get filed whole
+            and on their own; and each gets its own answers back """
+        printer = LlamaWriter.LlamaVirtualPrinter( self.config, 'net', 'tcp:127.0.0.1:0' )
+        jobs = [ [ b'JOB %d PART ONE\r' % n, b'JOB %d PART TWO\r\x0c' % n ] for n in range( 3 ) ]
+        jobs[1].insert( 1, b'\x1b?' )
+        answers = {}
+
+        async def Run():
+            await printer.Start()
+            port = printer.closers[0].sockets[0].getsockname()[1]
+            clients = [ await asyncio.open_connection( '127.0.0.1', port ) for job in jobs ]
+
+            for part in range( 3 ):
+                for job, ( reader, writer ) in zip( jobs, clients ):
+                    if part < len( job ):
+                        writer.write( job[ part ] )
+                        await writer.drain()
+                await asyncio.sleep( 0.05 )
+
+            for n, ( reader, writer ) in enumerate( clients ):
+                writer.write_eof()
+                answers[ n ] = await reader.read()
+                writer.close()
+
+            for tries in range( 200 ):
+                if printer.clients == 0:
+                    break
+                await asyncio.sleep( 0.01 )
+            await printer.Stop()
+
+        self.Quietly( asyncio.run, Run() )
+
+        self.assertEqual( printer.jobs, 3 )
+        self.assertEqual( printer.received, sum( len( b''.join( job )) for job in jobs ))
+        self.assertEqual( answers, { 0 : b'', 1 : b'IW10C', 2 : b'' } )
+
+        printdir = printer.config[ 'printdir' ]
+        captured = sorted( b''.join( LlamaWriter.LlamaCapture.DataChunks( printdir + name ))
+            for name in os.listdir( printdir ) if name.endswith( '.raw.gz' ))
+        self.assertEqual( captured, sorted( b''.join( job ) for job in jobs ))
+
+        pages = [ name for name in os.listdir( printdir ) if name.endswith( '.html' ) ]
+        self.assertEqual( len( pages ), 3 )
+        for name in pages:
+            with open( printdir + name, 'rb' ) as html:
+                found = re.findall( rb'JOB \d', html.read() )
+            self.assertEqual( len( found ), 2 )
+            self.assertEqual( found[0], found[1] )
+        self.assertFalse( any( name.startswith( '.job-' ) for name in os.listdir( printdir )))
+
+
+if __name__ == '__main__':
+    unittest.main()